@@ -1,15 +1,28 @@
 from itertools import product
 from flask import Flask, request, jsonify,Response , stream_with_context
-import os, json, io, traceback
+import os, json, io, traceback, base64
 import requests
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps
 import firebase_admin
 from firebase_admin import credentials, storage, db as rtdb, firestore, messaging
+from firebase_admin import exceptions as firebase_exceptions
+from google.api_core import exceptions as gcp_exceptions
 
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from datetime import datetime, timedelta, timezone
 import time
+import hashlib
+import queue
+import threading
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from functools import partial
+from typing import Optional
 from datetime import datetime
  
  
@@ -50,25 +63,432 @@ bucket = storage.bucket()
 # Utils
 # ------------------------------------
     #-----ฟังก์ชันส่ง FCM (Backend) Firebase Cloud Messaging (FCM) แจ้งร้าน
-def send_fcm_to_partner(fcm_token, title, body, data=None):
-    try:
-        if not fcm_token:
+# request thread แค่ enqueue → background thread รวมส่งเป็น send_each
+FCM_QUEUE_SIZE = int(os.environ.get("FCM_QUEUE_SIZE", 1000))
+FCM_BATCH_SIZE = 500            # limit ของ send_each
+FCM_MAX_RETRIES = 3
+FCM_RETRY_BACKOFF = 0.5         # วินาที (x2 ทุกครั้งที่ retry)
+
+# token ใช้ไม่ได้แล้ว → ลบออกจาก account doc
+FCM_INVALID_TOKEN_ERRORS = (
+    messaging.UnregisteredError,
+    messaging.SenderIdMismatchError,
+)
+# error ชั่วคราว → retry
+FCM_TRANSIENT_ERRORS = (
+    messaging.QuotaExceededError,
+    firebase_exceptions.UnavailableError,
+    firebase_exceptions.InternalError,
+    firebase_exceptions.DeadlineExceededError,
+)
+
+
+@firestore.transactional
+def _prune_fcm_token(transaction, token_ref, token):
+    # ลบเฉพาะเมื่อยังเป็น token ที่ส่งไม่ผ่าน → token ใหม่จาก /register_fcm_token ไม่หาย
+    snap = token_ref.get(transaction=transaction)
+    if not snap.exists or (snap.to_dict() or {}).get("fcm_token") != token:
+        return False
+    transaction.update(token_ref, {"fcm_token": firestore.DELETE_FIELD})
+    return True
+
+
+class NotificationDispatcher:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats_lock = threading.Lock()     # stats แก้จากทั้ง request thread และ dispatcher
+        self.stats = {
+            "enqueued": 0,
+            "dropped": 0,
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "invalid_tokens": 0,
+            "pruned": 0,
+            "batches": 0,
+            "last_batch_ms": 0.0,
+            "max_batch_ms": 0.0,
+        }
+
+    def _count(self, key, n=1):
+        with self.stats_lock:
+            self.stats[key] += n
+
+    def start(self):
+        # start ตอนใช้ครั้งแรก → ได้ thread ใน gunicorn worker ไม่ใช่ master
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._run, name="fcm-dispatcher", daemon=True
+                )
+                self.thread.start()
+
+    def enqueue(self, fcm_token, title, body, data=None, token_ref=None):
+        """
+        token_ref = account doc ที่มี field fcm_token
+        ถ้าไม่ส่ง fcm_token มา dispatcher จะอ่าน token จาก token_ref เอง
+        """
+        if not fcm_token and token_ref is None:
+            return False
+
+        self.start()
+
+        try:
+            self.queue.put_nowait({
+                "token": fcm_token,
+                "token_ref": token_ref,
+                "title": title,
+                "body": body,
+                "data": {k: str(v) for k, v in (data or {}).items()},
+            })
+        except queue.Full:
+            self._count("dropped")
+            print("❌ FCM queue full, drop:", title)
+            return False
+
+        self._count("enqueued")
+        return True
+
+    def metrics(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        return dict(stats, queue_depth=self.queue.qsize(), queue_max=self.queue.maxsize)
+
+    def _run(self):
+        while True:
+            pending = [self.queue.get()]
+
+            # รวม message ที่ค้างอยู่เป็น batch เดียว
+            while len(pending) < FCM_BATCH_SIZE:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._send(pending)
+            except Exception as e:
+                self._count("failed", len(pending))
+                print("❌ FCM dispatcher error:", e)
+
+    def _resolve_tokens(self, pending):
+        refs = {p["token_ref"].path: p["token_ref"] for p in pending
+                if not p["token"] and p["token_ref"] is not None}
+
+        tokens = {}
+        if refs:
+            for snap in db.get_all(list(refs.values())):
+                if snap.exists:
+                    tokens[snap.reference.path] = (snap.to_dict() or {}).get("fcm_token")
+
+        ready = []
+        for p in pending:
+            if not p["token"]:
+                p["token"] = tokens.get(p["token_ref"].path)
+            if p["token"]:
+                ready.append(p)
+
+        return ready
+
+    def _prune(self, item):
+        self._count("invalid_tokens")
+        if item["token_ref"] is None:
             return
+        try:
+            if _prune_fcm_token(db.transaction(), item["token_ref"], item["token"]):
+                self._count("pruned")
+        except Exception as e:
+            print("❌ FCM prune error:", e)
+
+    def _send(self, pending):
+        items = self._resolve_tokens(pending)
+        attempt = 0
+
+        while items:
+            messages = [
+                messaging.Message(
+                    notification=messaging.Notification(
+                        title=p["title"],
+                        body=p["body"]
+                    ),
+                    data=p["data"],
+                    token=p["token"]
+                )
+                for p in items
+            ]
 
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=title,
-                body=body
-            ),
-            data=data or {},
-            token=fcm_token
-        )
+            started = time.time()
+            retry = []
 
-        messaging.send(message)
+            try:
+                response = messaging.send_each(messages)
+            except FCM_TRANSIENT_ERRORS:
+                retry = items
+            else:
+                for item, r in zip(items, response.responses):
+                    if r.success:
+                        self._count("sent")
+                    elif isinstance(r.exception, FCM_INVALID_TOKEN_ERRORS):
+                        self._prune(item)
+                    elif isinstance(r.exception, FCM_TRANSIENT_ERRORS):
+                        retry.append(item)
+                    else:
+                        self._count("failed")
+                        print("❌ FCM error:", r.exception)
+
+            elapsed_ms = round((time.time() - started) * 1000, 1)
+            with self.stats_lock:
+                self.stats["batches"] += 1
+                self.stats["last_batch_ms"] = elapsed_ms
+                self.stats["max_batch_ms"] = max(self.stats["max_batch_ms"], elapsed_ms)
+
+            attempt += 1
+            if retry and attempt > FCM_MAX_RETRIES:
+                self._count("failed", len(retry))
+                print("❌ FCM give up after retry:", len(retry))
+                break
 
-    except Exception as e:
-        print("❌ FCM error:", e)
+            if retry:
+                self._count("retried", len(retry))
+                time.sleep(FCM_RETRY_BACKOFF * (2 ** (attempt - 1)))
+
+            items = retry
+
+
+fcm_dispatcher = NotificationDispatcher(FCM_QUEUE_SIZE)
+
+
+def send_fcm_to_partner(fcm_token, title, body, data=None, token_ref=None):
+    # ไม่ block request → แค่เข้าคิว
+    return fcm_dispatcher.enqueue(fcm_token, title, body, data, token_ref)
+
+
+@app.route("/fcm_stats", methods=["GET"])
+def fcm_stats():
+    return jsonify(fcm_dispatcher.metrics())
  
+#----------------------------------------------
+# Fan-out: งาน I/O ที่อิสระต่อกัน (เช่น ต่อร้าน) รันขนานใน thread pool
+# FANOUT_PARALLEL=0 → รันทีละงาน (ไว้ benchmark เทียบ)
+#----------------------------------------------
+FANOUT_PARALLEL = os.environ.get("FANOUT_PARALLEL", "1") == "1"
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", 8))
+FANOUT_DEADLINE = float(os.environ.get("FANOUT_DEADLINE", 10))   # วินาที ต่อ request
+
+_fanout_executor = ThreadPoolExecutor(
+    max_workers=FANOUT_WORKERS,
+    thread_name_prefix="fanout"
+)
+
+
+def run_fanout(tasks, parallel=None, deadline=None):
+    """
+    tasks = {key: callable}
+    คืน (results, errors) แยกตาม key → งานหนึ่งพังไม่ทำให้งานอื่นหาย
+    """
+    parallel = FANOUT_PARALLEL if parallel is None else parallel
+    deadline = FANOUT_DEADLINE if deadline is None else deadline
+
+    results, errors = {}, {}
+
+    if not parallel or len(tasks) < 2:
+        for key, fn in tasks.items():
+            try:
+                results[key] = fn()
+            except Exception as e:
+                errors[key] = str(e)
+        return results, errors
+
+    futures = {_fanout_executor.submit(fn): key for key, fn in tasks.items()}
+    done, not_done = wait(futures, timeout=deadline)
+
+    for f in done:
+        try:
+            results[futures[f]] = f.result()
+        except Exception as e:
+            errors[futures[f]] = str(e)
+
+    for f in not_done:
+        f.cancel()
+        errors[futures[f]] = "deadline exceeded"
+
+    return results, errors
+
+#----------------------------------------------
+# Write plan: เก็บ mutation ทั้งหมดไว้ก่อน แล้ว commit เป็น WriteBatch
+# จำนวน round trip = จำนวน batch ไม่ใช่จำนวน document
+#----------------------------------------------
+FIRESTORE_BATCH_LIMIT = 500   # limit ของ Firestore ต่อ 1 commit
+
+
+class WritePlan:
+    def __init__(self):
+        self.ops = []
+
+    def __len__(self):
+        return len(self.ops)
+
+    def set(self, ref, data, merge=False):
+        self.ops.append(("set", ref, data, merge, None))
+
+    def update(self, ref, data, option=None):
+        # option = db.write_option(last_update_time=...) → fail ถ้า doc ถูกแก้หลังอ่าน
+        self.ops.append(("update", ref, data, False, option))
+
+    def create(self, ref, data):
+        # fail ทั้ง batch ถ้ามี document อยู่แล้ว (ใช้กันงานซ้ำ)
+        self.ops.append(("create", ref, data, False, None))
+
+    def delete(self, ref):
+        self.ops.append(("delete", ref, None, False, None))
+
+    def commit(self):
+        """commit ทุก op ตามลำดับ คืนค่าจำนวน commit ที่ใช้"""
+        commits = 0
+
+        for start in range(0, len(self.ops), FIRESTORE_BATCH_LIMIT):
+            batch = db.batch()
+
+            for op, ref, data, merge, option in self.ops[start:start + FIRESTORE_BATCH_LIMIT]:
+                if op == "set":
+                    batch.set(ref, data, merge=merge)
+                elif op == "create":
+                    batch.create(ref, data)
+                elif op == "update":
+                    batch.update(ref, data, option=option)
+                else:
+                    batch.delete(ref)
+
+            batch.commit()
+            commits += 1
+
+        self.ops = []
+        return commits
+
+#----------------------------------------------
+def get_docs(refs):
+    """อ่านหลาย document ใน round trip เดียว คืนตามลำดับ refs"""
+    snaps = {snap.reference.path: snap for snap in db.get_all(refs)}
+    return [snaps[ref.path] for ref in refs]
+
+#----------------------------------------------
+# Document cache (read-through) สำหรับ profile
+# customers / delivery / partner — LRU + TTL ต่อ collection + hit/miss
+#----------------------------------------------
+DOC_CACHE_MAX_ENTRIES = int(os.environ.get("DOC_CACHE_MAX_ENTRIES", 10000))
+DOC_CACHE_TTLS = {          # วินาที ต่อ collection id
+    "customers": 60,
+    "delivery": 30,
+    "partner": 120,
+}
+DOC_CACHE_DEFAULT_TTL = 30
+# ไม่มี document → cache สั้น ๆ (register ใน worker อื่นจะได้เห็นเร็ว)
+DOC_CACHE_MISSING_TTL = 5
+
+
+class DocumentCache:
+    def __init__(self, max_entries, ttls, default_ttl, missing_ttl):
+        self.max_entries = max_entries
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.missing_ttl = missing_ttl
+        self.entries = OrderedDict()    # doc path -> (data | None, cached_at)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _ttl(self, ref, data):
+        if data is None:
+            return self.missing_ttl
+        return self.ttls.get(ref.parent.id, self.default_ttl)
+
+    def _lookup(self, ref, now):
+        with self.lock:
+            cached = self.entries.get(ref.path)
+            if cached and now - cached[1] < self._ttl(ref, cached[0]):
+                self.entries.move_to_end(ref.path)
+                self.stats["hits"] += 1
+                return True, cached[0]
+            self.stats["misses"] += 1
+            return False, None
+
+    def _store(self, path, data, now):
+        with self.lock:
+            self.entries[path] = (data, now)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def get(self, ref, cache_missing=True):
+        """
+        dict ของ document (None = ไม่มี document)
+        cache_missing=False → ไม่เชื่อ/ไม่เก็บผล "ไม่มี" (login หลัง register)
+        """
+        now = time.time()
+        found, data = self._lookup(ref, now)
+        if found and (data is not None or cache_missing):
+            return data
+
+        snap = ref.get()
+        data = (snap.to_dict() or {}) if snap.exists else None
+        if data is not None or cache_missing:
+            self._store(ref.path, data, now)
+        return data
+
+    def get_many(self, refs):
+        """
+        คืน {doc path: dict} (ไม่มี document → {})
+        ที่ไม่อยู่ใน cache อ่านด้วย get_all ครั้งเดียว
+        """
+        now = time.time()
+        result = {}
+        missing = {}
+
+        for ref in refs:
+            found, data = self._lookup(ref, now)
+            if found:
+                result[ref.path] = data or {}
+            else:
+                missing[ref.path] = ref
+
+        if missing:
+            for snap in db.get_all(list(missing.values())):
+                data = (snap.to_dict() or {}) if snap.exists else None
+                self._store(snap.reference.path, data, now)
+                result[snap.reference.path] = data or {}
+
+        return result
+
+    def invalidate(self, ref):
+        with self.lock:
+            if self.entries.pop(ref.path, None) is not None:
+                self.stats["invalidations"] += 1
+
+    def metrics(self):
+        with self.lock:
+            total = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                entries=len(self.entries),
+                max_entries=self.max_entries,
+                hit_rate=round(self.stats["hits"] / total, 3) if total else 0.0
+            )
+
+
+doc_cache = DocumentCache(
+    DOC_CACHE_MAX_ENTRIES,
+    DOC_CACHE_TTLS,
+    DOC_CACHE_DEFAULT_TTL,
+    DOC_CACHE_MISSING_TTL
+)
+
+
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    return jsonify(doc_cache.metrics())
+
 #----------------------------------------------
 def build_prefixes(text: str):
     text = text.lower().strip()
@@ -78,61 +498,156 @@ def build_prefixes(text: str):
         current += ch
         prefixes.append(current)
     return prefixes
+#************************ Fee config cache ****************
+# costservice_shop  = 'min,percent,max'
+# costservice_rider = 'percent'
+# โหลดจาก RTDB ครั้งเดียว → refresh ด้วย listener หรือหมดอายุตาม TTL
+FEE_CONFIG_TTL = float(os.environ.get("FEE_CONFIG_TTL", 60))
+
+
+@dataclass(frozen=True)
+class FeeConfig:
+    shop_min: Optional[float]
+    shop_percent: Optional[float]
+    shop_max: Optional[float]
+    rider_percent: Optional[float]
+    version: str
+    loaded_at: float
+
+
+_fee_config = None
+_fee_config_lock = threading.Lock()
+_fee_listeners = []
+
+
+def parse_fee_config(raw_shop, raw_rider) -> FeeConfig:
+    shop_min = shop_percent = shop_max = None
+    if raw_shop:
+        try:
+            shop_min, shop_percent, shop_max = map(float, str(raw_shop).split(","))
+        except Exception:
+            shop_min = shop_percent = shop_max = None
+
+    rider_percent = None
+    if raw_rider is not None:
+        try:
+            rider_percent = float(raw_rider)  # รองรับ "10" หรือ 10
+        except Exception as e:
+            print("calc_costrider error:", e)
+
+    # version = hash ของค่าดิบ → ตรงกันทุก worker ใช้ audit ได้
+    version = hashlib.sha1(f"{raw_shop}|{raw_rider}".encode("utf-8")).hexdigest()[:12]
+
+    return FeeConfig(shop_min, shop_percent, shop_max, rider_percent, version, time.time())
+
+
+def _fee_config_listener():
+    # listen() ส่ง event แรก (ค่าปัจจุบัน) ทันที → ข้าม ไม่งั้นล้าง config ที่เพิ่งโหลด
+    primed = threading.Event()
+
+    def on_change(event):
+        global _fee_config
+        if not primed.is_set():
+            primed.set()
+            return
+        with _fee_config_lock:
+            _fee_config = None
+
+    return on_change
+
+
+def _start_fee_listeners():
+    """เรียกขณะถือ _fee_config_lock → register ครั้งเดียวต่อ process"""
+    if _fee_listeners:
+        return
+    try:
+        for key in ("costservice_shop", "costservice_rider"):
+            _fee_listeners.append(rtdb.reference(key).listen(_fee_config_listener()))
+    except Exception as e:
+        # ไม่มี listener ก็ยังใช้ TTL ได้
+        print("fee config listener error:", e)
+
+
+def get_fee_config() -> FeeConfig:
+    global _fee_config
+
+    config = _fee_config
+    if config and time.time() - config.loaded_at < FEE_CONFIG_TTL:
+        return config
+
+    with _fee_config_lock:
+        config = _fee_config
+        if config and time.time() - config.loaded_at < FEE_CONFIG_TTL:
+            return config
+
+        config = parse_fee_config(
+            rtdb_ref.child("costservice_shop").get(),
+            rtdb_ref.child("costservice_rider").get()
+        )
+        _fee_config = config
+        _start_fee_listeners()
+
+    return config
+
 #************************ ค่าบริการระบ คิดกับร้านค้า **************** 
-def calc_costservice(shop_total: float):
+def calc_costservice(shop_total: float, config: FeeConfig = None):
     """
-    อ่าน costservice_shop จาก RTDB
+    ใช้ costservice_shop จาก fee config cache
     format: 'min,percent,max'
     """
-    raw = rtdb_ref.child("costservice_shop").get()
+    config = config or get_fee_config()
 
-    if not raw:
+    if config.shop_percent is None:
         return 0  # fallback ปลอดภัย
 
-    try:
-        min_v, percent_v, max_v = map(float, str(raw).split(","))
+    cost = shop_total * (config.shop_percent / 100.0)
 
-        cost = shop_total * (percent_v / 100.0)
+    if cost < config.shop_min:
+        cost = config.shop_min
+    elif cost > config.shop_max:
+        cost = config.shop_max
 
-        if cost < min_v:
-            cost = min_v
-        elif cost > max_v:
-            cost = max_v
+    return round(cost, 2)
 
-        return round(cost, 2)
+#************************ ค่าบริการระบ คิดกับ rider **************** 
+def calc_costrider(price_total: float, config: FeeConfig = None) -> float:
+    config = config or get_fee_config()
 
-    except Exception:
+    if config.rider_percent is None:
         return 0
 
-#************************ ค่าบริการระบ คิดกับ rider **************** 
-def calc_costrider(price_total: float) -> float:
-    try:
-        percent = rtdb_ref.child("costservice_rider").get()
+    return round(price_total * config.rider_percent / 100, 2)
 
-        if percent is None:
-            return 0
+#-----------------------ดึงรูปจาก Firebase Storage----------------------------------------
+# ทำ public ครั้งเดียวตอน sync (admin) → endpoint อ่านอย่างเดียว ไม่เขียน storage
+BOOKBANK_PREFIX = "bookbankpayment/"
+BOOKBANK_CACHE_TTL = float(os.environ.get("BOOKBANK_CACHE_TTL", 600))
+_bookbank_cache = {"images": None, "loaded_at": 0.0}
 
-        percent = float(percent)  # รองรับ "10" หรือ 10
-        return round(price_total * percent / 100, 2)
 
-    except Exception as e:
-        print("calc_costrider error:", e)
-        return 0
+def list_bookbank_blobs():
+    # เอาเฉพาะไฟล์รูป
+    return [
+        blob for blob in bucket.list_blobs(prefix=BOOKBANK_PREFIX)
+        if blob.name.lower().endswith((".png", ".jpg", ".jpeg"))
+    ]
+
+
+def refresh_bookbank_images():
+    # public_url คำนวณจากชื่อ ไม่ต้องเรียก storage เพิ่ม
+    images = [blob.public_url for blob in list_bookbank_blobs()]
+    _bookbank_cache["images"] = images
+    _bookbank_cache["loaded_at"] = time.time()
+    return images
+
 
-#-----------------------ดึงรูปจาก Firebase Storage----------------------------------------
 @app.route("/get_bookbank_images", methods=["GET"])
 def get_bookbank_images():
     try:
-        blobs = bucket.list_blobs(prefix="bookbankpayment/")
+        image_urls = _bookbank_cache["images"]
 
-        image_urls = []
-
-        for blob in blobs:
-            # เอาเฉพาะไฟล์รูป
-            if blob.name.lower().endswith((".png", ".jpg", ".jpeg")):
-                # ทำ public url
-                blob.make_public()
-                image_urls.append(blob.public_url)
+        if image_urls is None or time.time() - _bookbank_cache["loaded_at"] > BOOKBANK_CACHE_TTL:
+            image_urls = refresh_bookbank_images()
 
         return jsonify({
             "success": True,
@@ -145,6 +660,37 @@ def get_bookbank_images():
             "error": str(e)
         }), 500
 
+
+@app.route("/sync_bookbank_images", methods=["POST"])
+def sync_bookbank_images():
+    """admin: ทำรูปที่อัปโหลดใหม่เป็น public แล้ว refresh cache"""
+    try:
+        data = request.get_json(silent=True) or {}
+
+        # ACL write ทีละ blob → เฉพาะ admin ที่ login แล้ว (token จาก /ofm_password)
+        if not session_from_request(data, "admin"):
+            return jsonify({"success": False, "error": "invalid_token"}), 401
+
+        published = 0
+
+        for blob in list_bookbank_blobs():
+            blob.make_public()
+            published += 1
+
+        images = refresh_bookbank_images()
+
+        return jsonify({
+            "success": True,
+            "published": published,
+            "images": images
+        })
+
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
 #-----------------------สร้าง Config API -------
 @app.route("/get_api_config", methods=["GET"])
 def get_api_config():
@@ -171,48 +717,122 @@ def get_api_config():
 @firestore.transactional
 def update_qty(transaction, ref, delta):
     snap = ref.get(transaction=transaction)
-    qty = snap.get("numberproduct")
+    if not snap.exists:
+        return False
+    qty = (snap.to_dict() or {}).get("numberproduct", 1)
     transaction.update(ref, {"numberproduct": max(qty + delta, 1)})
+    return True
 
 
 
 
     #-----------โหลด หมวดทั้งหมด
+WAREHOUSE_MODES_TTL = float(os.environ.get("WAREHOUSE_MODES_TTL", 600))
+_warehouse_modes = {"modes": None, "loaded_at": 0.0}
+
+
 @app.route("/warehouse/modes", methods=["GET"])
 def get_warehouse_modes():
-    prefix = "warehouseMode/"
-    modes = set()
+    modes = _warehouse_modes["modes"]
+
+    if modes is None or time.time() - _warehouse_modes["loaded_at"] > WAREHOUSE_MODES_TTL:
+        prefix = "warehouseMode/"
+
+        # delimiter → GCS คืนเฉพาะ "folder" ชั้นแรก ไม่ต้องไล่ทุกรูป
+        blobs = bucket.list_blobs(prefix=prefix, delimiter="/")
+        for _ in blobs:
+            pass
+
+        modes = sorted(
+            p[len(prefix):].rstrip("/")
+            for p in blobs.prefixes
+            if p[len(prefix):].rstrip("/")
+        )
+        _warehouse_modes["modes"] = modes
+        _warehouse_modes["loaded_at"] = time.time()
+
+    return jsonify(modes)
+
 
-    for blob in bucket.list_blobs(prefix=prefix):
-        parts = blob.name.split("/")
-        if len(parts) > 1 and parts[1]:
-            modes.add(parts[1])
+def invalidate_warehouse_cache():
+    _warehouse_modes["modes"] = None
+    _warehouse_listings.clear()
 
-    return jsonify(sorted(list(modes)))
+
+@app.route("/warehouse/refresh", methods=["POST"])
+def refresh_warehouse():
+    """เรียกหลังอัปโหลดรูปเข้า warehouseMode/ → ล้าง cache หมวด + รายการรูป"""
+    invalidate_warehouse_cache()
+    return jsonify({"success": True})
 
    #-----------โหลดรูปทั้งหมด
 from datetime import timedelta
 
+# signed url ใช้ซ้ำได้จนใกล้หมดอายุ (เซ็น RSA ใหม่เฉพาะตอนจำเป็น)
+SIGNED_URL_EXPIRATION = timedelta(hours=1)
+SIGNED_URL_REFRESH_MARGIN = 300        # วินาที ก่อนหมดอายุที่จะเซ็นใหม่
+SIGNED_URL_CACHE_MAX = int(os.environ.get("SIGNED_URL_CACHE_MAX", 5000))
+WAREHOUSE_LISTING_TTL = float(os.environ.get("WAREHOUSE_LISTING_TTL", 300))
+
+_signed_urls = OrderedDict()    # (blob name, generation) -> (url, expires_at) LRU
+_signed_urls_lock = threading.Lock()
+_warehouse_listings = {}        # prefix -> ([(name, generation)], loaded_at)
+
+
+def get_signed_url(name, generation=None):
+    key = (name, generation)
+    now = time.time()
+
+    with _signed_urls_lock:
+        cached = _signed_urls.get(key)
+        if cached and cached[1] - now > SIGNED_URL_REFRESH_MARGIN:
+            _signed_urls.move_to_end(key)
+            return cached[0]
+
+    url = bucket.blob(name).generate_signed_url(
+        version="v4",
+        expiration=SIGNED_URL_EXPIRATION,
+        method="GET"
+    )
+
+    with _signed_urls_lock:
+        _signed_urls[key] = (url, now + SIGNED_URL_EXPIRATION.total_seconds())
+        _signed_urls.move_to_end(key)
+        while len(_signed_urls) > SIGNED_URL_CACHE_MAX:
+            _signed_urls.popitem(last=False)
+
+    return url
+
+
+def list_warehouse_images(prefix):
+    cached = _warehouse_listings.get(prefix)
+    if cached and time.time() - cached[1] < WAREHOUSE_LISTING_TTL:
+        return cached[0]
+
+    images = [
+        (blob.name, blob.generation)
+        for blob in bucket.list_blobs(prefix=prefix)
+        if blob.name.lower().endswith((".jpg", ".png", ".jpeg"))
+    ]
+    _warehouse_listings[prefix] = (images, time.time())
+    return images
+
+
 @app.route("/warehouse/images/<path:mode>", methods=["GET"])
 def get_warehouse_images_by_mode(mode):
     prefix = f"warehouseMode/{mode}/"
     images = []
 
-    for blob in bucket.list_blobs(prefix=prefix):
-        if blob.name.lower().endswith((".jpg", ".png", ".jpeg")):
-            url = blob.generate_signed_url(
-                version="v4",
-                expiration=timedelta(hours=1),
-                method="GET"
-            )
+    for name, generation in list_warehouse_images(prefix):
+        url = get_signed_url(name, generation)
 
-            filename = os.path.basename(blob.name)  # ชื่อไฟล์
-            name_only = os.path.splitext(filename)[0]  # ตัด .jpg
+        filename = os.path.basename(name)  # ชื่อไฟล์
+        name_only = os.path.splitext(filename)[0]  # ตัด .jpg
 
-            images.append({
-                "imageUrl": url,
-                "imageName": name_only
-            })
+        images.append({
+            "imageUrl": url,
+            "imageName": name_only
+        })
 
     return jsonify(images)
 
@@ -250,31 +870,40 @@ def get_modes_by_ofm(name_ofm):
  
 
 #---ดึงสินค้า
+# index: OFM_name/{ofm}/modproduct/{mode}.shops (save_product เป็นคน update)
+# shops_indexed = True เมื่อ index ครบแล้ว (backfill จาก fallback)
 @app.route("/get_shops_by_mode/<nameOfm>/<mode>", methods=["GET"])
 def get_shops_by_mode(nameOfm, mode):
-    shops = []
+    ofm_ref = db.collection("OFM_name").document(nameOfm)
+    index_ref = ofm_ref.collection("modproduct").document(mode)
 
-    partners = (
-        db.collection("OFM_name")
-          .document(nameOfm)
-          .collection("partner")
-          .stream()
-    )
+    index_doc = index_ref.get()
+    index_data = (index_doc.to_dict() or {}) if index_doc.exists else {}
 
-    for p in partners:
-        mode_ref = (
-            db.collection("OFM_name")
-              .document(nameOfm)
-              .collection("partner")
-              .document(p.id)
-              .collection("mode")
-              .document(mode)
-        )
+    if index_data.get("shops_indexed"):
+        return jsonify(sorted(index_data.get("shops", [])))
 
-        if mode_ref.get().exists:
-            shops.append(p.id)
+    # fallback: ref ของทุกร้าน + get_all ทีเดียว (ไม่ใช่ 1 get ต่อร้าน)
+    partners = ofm_ref.collection("partner").select([]).stream()
+    mode_refs = [
+        p.reference.collection("mode").document(mode)
+        for p in partners
+    ]
 
-    return jsonify(shops)
+    shops = []
+    if mode_refs:
+        for snap in db.get_all(mode_refs):
+            if snap.exists:
+                # .../partner/{shop}/mode/{mode}
+                shops.append(snap.reference.parent.parent.id)
+
+    if index_doc.exists:
+        index_ref.set({
+            "shops": firestore.ArrayUnion(shops),
+            "shops_indexed": True
+        }, merge=True)
+
+    return jsonify(sorted(shops))
 
 # --- ดึงสินค้า
 @app.route("/get_products/<name_ofm>/<slave_name>/<view_modename>", methods=["GET"])
@@ -299,6 +928,7 @@ def get_products_by_mode(name_ofm, slave_name, view_modename):
             "ProductDetail": data.get("dataproduct", ""),  # ✅ แก้ตรงนี้
             "Price": data.get("priceproduct", 0),
             "imageurl": data.get("image_url", ""),
+            "imageurls": product_image_urls(data),
         })
 
     return jsonify(products)
@@ -306,6 +936,48 @@ def get_products_by_mode(name_ofm, slave_name, view_modename):
 
 
 #-------------------------------------
+# active order (ตะกร้า) ต่อลูกค้า
+# customer.activePreorder = Preorder ของ order preorderSyncedId (mirror)
+# เชื่อ mirror เฉพาะเมื่อ preorderSyncedId == activeOrderId (ตั้งโดย _ensure_active_order)
+# apply_cart_ops ปรับ mirror ใน transaction เดียวกับ order, confirm_order ลบทิ้ง
+@firestore.transactional
+def _ensure_active_order(transaction, customer_ref):
+    """ใช้ activeOrderId เดิมถ้ายังมี order อยู่ ไม่งั้นสร้างใหม่ — ทั้งหมดใน transaction เดียว"""
+    customer = customer_ref.get(transaction=transaction)
+    customer_data = (customer.to_dict() or {}) if customer.exists else {}
+    active_order_id = customer_data.get("activeOrderId", "")
+
+    if active_order_id:
+        order = customer_ref.collection("orders").document(active_order_id).get(transaction=transaction)
+        if order.exists:
+            # cart เดิม (ก่อนมี mirror) → backfill จาก order doc
+            preorder = (order.to_dict() or {}).get("Preorder", 0)
+            transaction.update(customer_ref, {
+                "preorderSyncedId": active_order_id,
+                "activePreorder": preorder
+            })
+            return active_order_id, preorder
+
+    timestamp_id = str(int(time.time() * 1000))
+
+    transaction.set(customer_ref.collection("orders").document(timestamp_id), {
+        "status": "draft",
+        "Preorder": 0,
+        "createdAt": datetime.utcnow()
+    })
+
+    update = {
+        "activeOrderId": timestamp_id,
+        "preorderSyncedId": timestamp_id,
+        "activePreorder": 0
+    }
+    if not customer.exists:
+        update["createdAt"] = datetime.utcnow()
+    transaction.set(customer_ref, update, merge=True)
+
+    return timestamp_id, 0
+
+
 @app.route("/get_preorder", methods=["GET"])
 def get_preorder():
     nameOfm = request.args.get("nameOfm")
@@ -324,69 +996,23 @@ def get_preorder():
           .document(userName)
     )
 
-    customer_doc = customer_ref.get()
-
-    # 1️⃣ ถ้ายังไม่มี customer → สร้าง
-    if not customer_doc.exists:
-        customer_ref.set({
-            "activeOrderId": "",
-            "createdAt": datetime.utcnow()
-        }, merge=True)
-
-        customer_doc = customer_ref.get()
-
-    customer_data = customer_doc.to_dict() or {}
+    # 1️⃣ customer doc อย่างเดียว: activeOrderId + Preorder ที่ mirror ไว้
+    customer = customer_ref.get()
+    customer_data = (customer.to_dict() or {}) if customer.exists else {}
     active_order_id = customer_data.get("activeOrderId", "")
 
-    # 2️⃣ ตรวจว่าต้องสร้าง order ใหม่ไหม
-    need_new_order = False
-
-    if active_order_id == "":
-        need_new_order = True
+    if active_order_id and customer_data.get("preorderSyncedId") == active_order_id:
+        active = (active_order_id, customer_data.get("activePreorder", 0))
     else:
-        check_ref = (
-            customer_ref
-              .collection("orders")
-              .document(active_order_id)
-        )
-        if not check_ref.get().exists:
-            need_new_order = True
-
-    # 3️⃣ สร้าง order ใหม่
-    if need_new_order:
-        timestamp_id = str(int(time.time() * 1000))
-
-        order_ref = (
-            customer_ref
-              .collection("orders")
-              .document(timestamp_id)
-        )
-
-        order_ref.set({
-            "status": "draft",
-            "Preorder": 0,
-            "createdAt": datetime.utcnow()
-        })
+        # 2️⃣ ไม่มี / ยังไม่มี mirror → สร้างหรือ backfill ใน transaction เดียว
+        active = _ensure_active_order(db.transaction(), customer_ref)
+        doc_cache.invalidate(customer_ref)
 
-        customer_ref.update({
-            "activeOrderId": timestamp_id
-        })
-
-        active_order_id = timestamp_id
-
-    # 4️⃣ อ่าน Preorder
-    order_ref = (
-        customer_ref
-          .collection("orders")
-          .document(active_order_id)
-    )
-
-    order_doc = order_ref.get()
-    order_data = order_doc.to_dict() or {}
+    active_order_id, preorder = active
 
     return jsonify({
         "status": "success",
-        "Preorder": order_data.get("Preorder", 0),
+        "Preorder": max(preorder, 0),
         "orderId": active_order_id
     })
 
@@ -404,13 +1030,11 @@ def get_customer():
               .document(userName)
         )
 
-        doc = doc_ref.get()
+        data = doc_cache.get(doc_ref)
 
-        if not doc.exists:
+        if data is None:
             return jsonify({}), 200
 
-        data = doc.to_dict()
-
         return jsonify({
             "CustomerName": data.get("username"),
             "PhoneNumber": data.get("phone"),
@@ -421,6 +1045,17 @@ def get_customer():
         return jsonify({"error": str(e)}), 500
 
 #----------------------------------------------
+def preorder_ref(nameOfm, userName, orderId):
+    return (
+        db.collection("OFM_name")
+          .document(nameOfm)
+          .collection("customers")
+          .document(userName)
+          .collection("orders")
+          .document(orderId)
+    )
+
+
 @app.route("/add_item_preorder", methods=["POST"])
 def add_item_preorder():
     data = request.json or {}
@@ -428,56 +1063,121 @@ def add_item_preorder():
     nameOfm = data.get("nameOfm")
     userName = data.get("userName")
     orderId = data.get("orderId")
-
     productname = data.get("productname")
-    priceproduct = data.get("priceproduct", 0)
-    image_url = data.get("image_url", "")
-    ProductDetail = data.get("productDetail", "")
-
-    Partnershop = data.get("partnershop", "")
 
     if not all([nameOfm, userName, orderId, productname]):
         return jsonify({"status": "error"}), 400
 
-    order_ref = (
-        db.collection("OFM_name")
-          .document(nameOfm)
-          .collection("customers")
-          .document(userName)
-          .collection("orders")
-          .document(orderId)
-    )
+    order_ref = preorder_ref(nameOfm, userName, orderId)
 
-    # ✅ 1. สร้าง document ก่อน
-    item_ref = order_ref.collection("items").document()
-    itemId = item_ref.id   # 👈 ItemID ที่ Firestore สร้างให้
-
-    # ✅ 2. บันทึกข้อมูล
-    item_ref.set({
-        "itemId": itemId,              # (ใส่หรือไม่ใส่ก็ได้ แต่แนะนำ)
-        "productname": productname,
-        "ProductDetail": ProductDetail,
-        "priceproduct": priceproduct,
-        "image_url": image_url,
-        "Partnershop": Partnershop,
-        "numberproduct": 1,
-        "status": "draft",
-        "ofmname": nameOfm,
-        "username": userName,
-        "created_at": datetime.utcnow()
+    # item set + Preorder Increment(1) ใน commit เดียว
+    try:
+        itemId = apply_cart_ops(order_ref, [dict(data, op="add")], nameOfm, userName)[0]
+    except gcp_exceptions.NotFound:
+        return jsonify({"status": "not_found"}), 404
+
+    # ✅ ส่ง itemId กลับ
+    return jsonify({
+        "status": "success",
+        "orderId": orderId,
+        "itemId": itemId
     })
 
-    # ✅ 3. update preorder count
-    order_doc = order_ref.get()
-    preorder = order_doc.to_dict().get("Preorder", 0) if order_doc.exists else 0
-    order_ref.update({"Preorder": preorder + 1})
+#----------------------------------------------
+@app.route("/add_items_preorder", methods=["POST"])
+def add_items_preorder():
+    """เพิ่มหลายสินค้าลงตะกร้าใน commit เดียว (items = list แบบ add_item_preorder)"""
+    data = request.json or {}
+
+    nameOfm = data.get("nameOfm")
+    userName = data.get("userName")
+    orderId = data.get("orderId")
+    items = data.get("items") or []
+
+    if not all([nameOfm, userName, orderId]) or not isinstance(items, list) or not items:
+        return jsonify({"status": "error"}), 400
+    if not all(isinstance(item, dict) for item in items):
+        return jsonify({"status": "error", "message": "item must be an object"}), 400
+
+    order_ref = preorder_ref(nameOfm, userName, orderId)
+
+    try:
+        item_ids = apply_cart_ops(
+            order_ref,
+            [dict(item, op="add") for item in items],
+            nameOfm,
+            userName
+        )
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except gcp_exceptions.NotFound:
+        return jsonify({"status": "not_found"}), 404
 
-    # ✅ 4. ส่ง itemId กลับ
     return jsonify({
         "status": "success",
         "orderId": orderId,
-        "itemId": itemId
+        "itemIds": item_ids
+    })
+
+#-----------------------cursor pagination (ใช้ร่วมหลาย endpoint)
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+
+
+def parse_page_size(value):
+    """pageSize จาก client → int ใน [1, PAGE_SIZE_MAX], ไม่ใช่ตัวเลข → ValueError"""
+    if value is None or value == "":
+        return PAGE_SIZE_DEFAULT
+    if isinstance(value, bool):
+        raise ValueError("invalid pageSize")
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("invalid pageSize")
+    return max(1, min(page_size, PAGE_SIZE_MAX))
+
+
+def encode_cursor(doc, field="createdAt"):
+    """token = base64(json) ของ field ที่ใช้เรียง + doc id"""
+    value = (doc.to_dict() or {}).get(field)
+    raw = json.dumps({
+        "t": value.isoformat() if isinstance(value, datetime) else None,
+        "id": doc.id
     })
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return {
+            "value": datetime.fromisoformat(raw["t"]) if raw.get("t") else None,
+            "id": raw["id"]
+        }
+    except Exception:
+        return None
+
+
+def cursor_values(col_ref, cursor, field="createdAt"):
+    return {
+        field: cursor["value"],
+        "__name__": col_ref.document(cursor["id"])
+    }
+
+
+def page_query(col_ref, field, page_size, cursor=None):
+    """เรียงใหม่ → เก่า ด้วย field + doc id (ใช้กับ cursor ด้านบน)"""
+    query = (
+        col_ref
+        .order_by(field, direction=firestore.Query.DESCENDING)
+        .order_by("__name__", direction=firestore.Query.DESCENDING)
+    )
+    if cursor:
+        query = query.start_after(cursor_values(col_ref, cursor, field))
+    return query.limit(page_size)
+
 #-----------------------API สำหรับเช็ค notification ใหม่
 @app.route("/partner_notifications", methods=["POST"])
 def partner_notifications():
@@ -512,13 +1212,30 @@ def partner_notifications():
             return jsonify({"success": True})
 
         # ==================================================
-        # 📥 2) LOAD NOTIFICATIONS
+        # 📥 2) LOAD NOTIFICATIONS (cursor = createdAt + doc id)
         # ==================================================
-        docs = (
-            orders_ref
-            .order_by("createdAt", direction=firestore.Query.DESCENDING)
-            .stream()
-        )
+        try:
+            page_size = parse_page_size(data.get("pageSize"))
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        cursor = decode_cursor(data.get("cursor"))
+        since = decode_cursor(data.get("since"))
+
+        if since:
+            # เฉพาะรายการที่ใหม่กว่า since (เก่า → ใหม่ แล้วกลับด้าน)
+            query = (
+                orders_ref
+                .order_by("createdAt", direction=firestore.Query.ASCENDING)
+                .order_by("__name__", direction=firestore.Query.ASCENDING)
+                .start_after(cursor_values(orders_ref, since))
+                .limit(page_size)
+            )
+        else:
+            query = page_query(orders_ref, "createdAt", page_size, cursor)
+
+        docs = list(query.stream())
+        if since:
+            docs.reverse()
 
         result = []
         for d in docs:
@@ -532,7 +1249,32 @@ def partner_notifications():
                 "createdAt": n.get("createdAt")
             })
 
-        return jsonify(result)
+        # หน้าถัดไป (เก่ากว่า) / cursor สำหรับ poll ครั้งหน้า (ใหม่กว่า)
+        next_cursor = None
+        if not since and len(docs) == page_size:
+            next_cursor = encode_cursor(docs[-1])
+
+        since_cursor = None
+        if docs and not cursor:
+            since_cursor = encode_cursor(docs[0])
+        elif since:
+            since_cursor = data.get("since")
+
+        if not any(k in data for k in ("pageSize", "cursor", "since")):
+            # client เดิมรับเป็น list → ส่ง cursor ทาง header
+            response = jsonify(result)
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+            if since_cursor:
+                response.headers["X-Since-Cursor"] = since_cursor
+            return response
+
+        return jsonify({
+            "success": True,
+            "notifications": result,
+            "nextCursor": next_cursor,
+            "sinceCursor": since_cursor
+        })
 
     except Exception as e:
         traceback.print_exc()
@@ -595,6 +1337,7 @@ def update_delivery_price():
         del_ref.update({
             "pricedelivery": pricedelivery
         })
+        doc_cache.invalidate(del_ref)
 
         return jsonify({
             "success": True,
@@ -632,16 +1375,14 @@ def get_delivery_user():
               .document(deluserName)
         )
 
-        doc = doc_ref.get()
+        data = doc_cache.get(doc_ref)
 
-        if not doc.exists:
+        if data is None:
             return jsonify({
                 "success": False,
                 "error": "delivery user not found"
             }), 404
 
-        data = doc.to_dict()
-
         # -------------------------------
         # 3) ส่งข้อมูลกลับ (จัด field ให้ตรง MAUI)
         # -------------------------------
@@ -747,9 +1488,30 @@ def get_partner_orders():
               .stream()
         )
 
+        docs = list(docs)
+        ofm_ref = db.collection("OFM_name").document(ofmname)
+
+        # ----------------------------------------
+        # 🔹 customer + rider ทั้งหน้า → get_all ครั้งเดียว
+        # ----------------------------------------
+        customer_refs = {}
+        delivery_refs = {}
+
+        for d in docs:
+            o = d.to_dict() or {}
+            user_name  = o.get("userName", "")
+            rider_name = o.get("del_nameservice", "")
+
+            if user_name:
+                customer_refs[user_name] = ofm_ref.collection("customers").document(user_name)
+            if rider_name:
+                delivery_refs[rider_name] = ofm_ref.collection("delivery").document(rider_name)
+
+        profiles = doc_cache.get_many(
+            list(customer_refs.values()) + list(delivery_refs.values())
+        )
+
         results = []
-        customer_cache = {}
-        delivery_cache = {}   # 🔥 cache rider pricedelivery
 
         for d in docs:
             o = d.to_dict() or {}
@@ -759,20 +1521,10 @@ def get_partner_orders():
             rider_name = o.get("del_nameservice", "")  # เช่น gorider
 
             # ----------------------------------------
-            # 🔹 customer info (cache)
+            # 🔹 customer info
             # ----------------------------------------
             if user_name:
-                if user_name not in customer_cache:
-                    cus_ref = (
-                        db.collection("OFM_name")
-                          .document(ofmname)
-                          .collection("customers")
-                          .document(user_name)
-                    )
-                    cus_doc = cus_ref.get()
-                    customer_cache[user_name] = cus_doc.to_dict() if cus_doc.exists else {}
-
-                customer_data = customer_cache[user_name]
+                customer_data = profiles[customer_refs[user_name].path]
             else:
                 customer_data = {}
 
@@ -782,20 +1534,7 @@ def get_partner_orders():
             pricedelivery = 0
 
             if rider_name:
-                if rider_name not in delivery_cache:
-                    delivery_ref = (
-                        db.collection("OFM_name")
-                          .document(ofmname)
-                          .collection("delivery")
-                          .document(rider_name)
-                    )
-                    delivery_doc = delivery_ref.get()
-
-                    delivery_cache[rider_name] = (
-                        delivery_doc.to_dict() if delivery_doc.exists else {}
-                    )
-
-                pricedelivery = delivery_cache[rider_name].get("pricedelivery", 0)
+                pricedelivery = profiles[delivery_refs[rider_name].path].get("pricedelivery", 0)
 
             # ----------------------------------------
             # 🔹 items (รองรับ MAP + ARRAY)
@@ -947,7 +1686,8 @@ def get_prerider_orders():
                 if shop_name in [
                     "status", "username", "createdAt",
                     "orderId", "pricedelivery",
-                    "mandelivery", "del_nameservice"
+                    "mandelivery", "del_nameservice",
+                    "customer"
                 ]:
                     continue
 
@@ -1016,25 +1756,32 @@ def get_rider_orders():
               .where("status", "==", "available")
         )
 
+        docs = list(orders_ref.stream())
+
+        # order เก่าที่ยังไม่มี snapshot ลูกค้า → อ่านรวมครั้งเดียว
+        customers_ref = db.collection("OFM_name").document(ofmname).collection("customers")
+        legacy_refs = {}
+
+        for d in docs:
+            o = d.to_dict() or {}
+            if "customer" not in o and o.get("username"):
+                legacy_refs[o["username"]] = customers_ref.document(o["username"])
+
+        profiles = doc_cache.get_many(list(legacy_refs.values()))
+
         results = []
 
-        for doc in orders_ref.stream():
+        for doc in docs:
             data = doc.to_dict()
 
             # ---------- customer ----------
             username = data.get("username", "")
-            customer = {}
-
-            if username:
-                cust_doc = (
-                    db.collection("OFM_name")
-                      .document(ofmname)
-                      .collection("customers")
-                      .document(username)
-                      .get()
-                )
-                if cust_doc.exists:
-                    c = cust_doc.to_dict()
+            customer = data.get("customer")
+
+            if customer is None:
+                customer = {}
+                c = profiles.get(legacy_refs[username].path) if username else None
+                if c:
                     customer = {
                         "name": c.get("name", c.get("username", "")),
                         "phone": c.get("phone", ""),
@@ -1166,6 +1913,270 @@ def get_notifications():
     return jsonify(result)
 
  
+#---------------------------------
+# SSE: push notification ใหม่ของร้านแทนการ poll
+# 1 on_snapshot listener ต่อร้าน → กระจายให้ทุก client ของร้านนั้น
+# event id = cursor (createdAt + doc id) → reconnect ด้วย Last-Event-ID ได้
+#---------------------------------
+SSE_HEARTBEAT_SECONDS = 15
+# 1 stream = 1 thread ของ worker → ปิดเองเป็นรอบ ๆ, client reconnect ต่อด้วย Last-Event-ID
+SSE_MAX_STREAM_SECONDS = float(os.environ.get("SSE_MAX_STREAM_SECONDS", 300))
+# stream พร้อมกันต่อ worker ไม่เกินครึ่งของ thread → API ปกติยังมี thread เหลือ
+SSE_MAX_STREAMS = int(os.environ.get(
+    "SSE_MAX_STREAMS",
+    max(int(os.environ.get("GUNICORN_THREADS", 16)) // 2, 1)
+))
+SSE_BUSY_RETRY_MS = 10000
+SSE_CLIENT_QUEUE_SIZE = 100
+SSE_REPLAY_LIMIT = PAGE_SIZE_MAX
+
+
+def notification_orders_ref(nameOfm, partnershop):
+    return (
+        db.collection("OFM_name")
+        .document(nameOfm)
+        .collection("partner")
+        .document(partnershop)
+        .collection("system")
+        .document("notification")
+        .collection("orders")
+    )
+
+
+def notification_event(doc):
+    data = doc.to_dict() or {}
+
+    created_at = data.get("createdAt")
+    created_at = (
+        created_at.isoformat()
+        if isinstance(created_at, datetime)
+        else None
+    )
+
+    return {
+        "id": encode_cursor(doc),
+        "docId": doc.id,
+        "data": {
+            "id": doc.id,
+            "orderId": str(data.get("orderId", "")),
+            "customerName": data.get("userName") or "",
+            "createdAt": created_at,
+            "read": bool(data.get("read"))
+        }
+    }
+
+
+class ShopNotificationHub:
+    def __init__(self, key, orders_ref):
+        self.key = key
+        self.orders_ref = orders_ref
+        self.subscribers = set()
+        self.watch = None
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=SSE_CLIENT_QUEUE_SIZE)
+
+        with self.lock:
+            self.subscribers.add(q)
+
+            if self.watch is None:
+                # ฟังเฉพาะ document ที่สร้างหลังจากนี้ → snapshot แรกว่าง ไม่เสีย read
+                self.watch = (
+                    self.orders_ref
+                    .where("createdAt", ">", datetime.now(timezone.utc))
+                    .on_snapshot(self._on_snapshot)
+                )
+
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+            if self.subscribers:
+                return
+            watch, self.watch = self.watch, None
+
+        with _notification_hubs_lock:
+            if _notification_hubs.get(self.key) is self and not self.subscribers:
+                _notification_hubs.pop(self.key)
+
+        if watch:
+            try:
+                watch.unsubscribe()
+            except Exception as e:
+                print("notification unsubscribe error:", e)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        events = [
+            notification_event(change.document)
+            for change in changes
+            if change.type.name == "ADDED"
+        ]
+        if not events:
+            return
+
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for q in subscribers:
+            for event in events:
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    # client ช้าเกิน → ตัดให้ reconnect แล้ว resume ด้วย Last-Event-ID
+                    self._close(q)
+                    break
+
+    def _close(self, q):
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                break
+        q.put_nowait(None)
+
+
+_notification_hubs = {}     # (nameOfm, partnershop) -> ShopNotificationHub
+_notification_hubs_lock = threading.Lock()
+
+
+def subscribe_notifications(nameOfm, partnershop):
+    """คืน (hub, queue) — subscribe ใน registry lock กัน unsubscribe คนสุดท้ายลบ hub ระหว่างทาง"""
+    key = (nameOfm, partnershop)
+    with _notification_hubs_lock:
+        hub = _notification_hubs.get(key)
+        if hub is None:
+            hub = ShopNotificationHub(key, notification_orders_ref(nameOfm, partnershop))
+            _notification_hubs[key] = hub
+        return hub, hub.subscribe()
+
+
+_sse_streams = 0
+_sse_streams_lock = threading.Lock()
+
+
+def acquire_sse_slot():
+    global _sse_streams
+    with _sse_streams_lock:
+        if _sse_streams >= SSE_MAX_STREAMS:
+            return False
+        _sse_streams += 1
+        return True
+
+
+def release_sse_slot():
+    global _sse_streams
+    with _sse_streams_lock:
+        _sse_streams -= 1
+
+
+def sse_message(event):
+    return (
+        f"id: {event['id']}\n"
+        f"event: notification\n"
+        f"data: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+    )
+
+
+@app.route("/partner_notifications/stream", methods=["GET"])
+def partner_notifications_stream():
+    nameOfm = request.args.get("nameOfm")
+    partnershop = request.args.get("partnershop")
+
+    if not nameOfm or not partnershop:
+        return jsonify({"error": "missing params"}), 400
+
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("lastEventId")
+    resume = decode_cursor(last_event_id)
+
+    # เต็ม → 503 ให้ลองใหม่ทีหลัง (ไม่กิน thread ของ worker)
+    if not acquire_sse_slot():
+        return Response(
+            f"retry: {SSE_BUSY_RETRY_MS}\n\n",
+            status=503,
+            mimetype="text/event-stream",
+            headers={"Retry-After": str(SSE_BUSY_RETRY_MS // 1000)}
+        )
+
+    try:
+        hub, q = subscribe_notifications(nameOfm, partnershop)
+    except Exception:
+        release_sse_slot()
+        raise
+
+    closed = threading.Lock()
+
+    def cleanup():
+        # เรียกได้ทั้งจาก generator และ call_on_close → ทำครั้งเดียว
+        if not closed.acquire(blocking=False):
+            return
+        hub.unsubscribe(q)
+        release_sse_slot()
+
+    # subscribe ก่อน replay → ไม่มีช่องว่างระหว่างสองส่วน (ซ้ำได้ กรองด้วย doc id)
+    replay = []
+    try:
+        if resume:
+            orders_ref = hub.orders_ref
+            replay = [
+                notification_event(d)
+                for d in (
+                    orders_ref
+                    .order_by("createdAt", direction=firestore.Query.ASCENDING)
+                    .order_by("__name__", direction=firestore.Query.ASCENDING)
+                    .start_after(cursor_values(orders_ref, resume))
+                    .limit(SSE_REPLAY_LIMIT)
+                    .stream()
+                )
+            ]
+    except Exception:
+        cleanup()
+        raise
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+
+            sent = set()
+            for event in replay:
+                sent.add(event["docId"])
+                yield sse_message(event)
+
+            deadline = time.time() + SSE_MAX_STREAM_SECONDS
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                try:
+                    event = q.get(timeout=min(SSE_HEARTBEAT_SECONDS, remaining))
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+
+                if event is None:
+                    break
+                if event["docId"] in sent:
+                    continue
+
+                yield sse_message(event)
+        finally:
+            cleanup()
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+    # client หลุดก่อน generator เริ่ม → finally ไม่ทำงาน
+    response.call_on_close(cleanup)
+    return response
+
+
 #--------------------------------------------
 @app.route("/get_costservice_orders", methods=["GET"])
 def get_costservice_orders():
@@ -1176,17 +2187,56 @@ def get_costservice_orders():
         if not ofmname or not nameshop:
             return jsonify({"success": False, "error": "missing params"}), 400
 
-        result = []
-
-        costservice_docs = (
+        costservice_col = (
             db.collection("OFM_name")
             .document(ofmname)
             .collection("partner")
             .document(nameshop)
             .collection("costservice")
-            .stream()
         )
 
+        # summary=1 → เฉพาะหัว STEMP (ยอดรวมที่เก็บไว้แล้ว) ทีละหน้า
+        # order ในแต่ละ STEMP ใช้ /get_costservice_period_orders
+        if request.args.get("summary") in ("1", "true"):
+            try:
+                page_size = parse_page_size(request.args.get("pageSize"))
+            except ValueError as e:
+                return jsonify({"success": False, "error": str(e)}), 400
+            stemp_docs = list(
+                page_query(
+                    costservice_col,
+                    "start_createdAt",
+                    page_size,
+                    decode_cursor(request.args.get("cursor"))
+                ).stream()
+            )
+
+            periods = []
+            for stemp_doc in stemp_docs:
+                stemp_data = stemp_doc.to_dict() or {}
+
+                start_created_at = stemp_data.get("start_createdAt")
+                if start_created_at:
+                    start_created_at = start_created_at.strftime("%Y-%m-%d %H:%M")
+
+                periods.append({
+                    "stempID": stemp_doc.id,
+                    "pay": stemp_data.get("pay", "not"),
+                    "start_createdAt": start_created_at,
+                    "price_allorderID": stemp_data.get("price_allorderID"),
+                    "costservice_allorderID": stemp_data.get("costservice_allorderID")
+                })
+
+            next_cursor = None
+            if len(stemp_docs) == page_size:
+                next_cursor = encode_cursor(stemp_docs[-1], "start_createdAt")
+
+            return jsonify({"success": True, "data": periods, "nextCursor": next_cursor}), 200
+
+        result = []
+
+        costservice_docs = costservice_col.stream()
+
         for stemp_doc in costservice_docs:
             stemp_data = stemp_doc.to_dict()
 
@@ -1225,12 +2275,145 @@ def get_costservice_orders():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+#--------------------------------------------
+@app.route("/get_costservice_period_orders", methods=["GET"])
+def get_costservice_period_orders():
+    try:
+        ofmname = request.args.get("ofmname")
+        nameshop = request.args.get("nameshop")
+        stemp_id = request.args.get("stempID")
+
+        if not ofmname or not nameshop or not stemp_id:
+            return jsonify({"success": False, "error": "missing params"}), 400
+
+        try:
+            page_size = parse_page_size(request.args.get("pageSize"))
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
+        orders_col = (
+            db.collection("OFM_name")
+            .document(ofmname)
+            .collection("partner")
+            .document(nameshop)
+            .collection("costservice")
+            .document(stemp_id)
+            .collection("orders")
+        )
+
+        order_docs = list(
+            page_query(
+                orders_col,
+                "createdAt",
+                page_size,
+                decode_cursor(request.args.get("cursor"))
+            ).stream()
+        )
+
+        orders = []
+        for order_doc in order_docs:
+            order = order_doc.to_dict() or {}
+
+            created_at = order.get("createdAt")
+            if created_at:
+                created_at = created_at.strftime("%Y-%m-%d %H:%M")
+
+            orders.append({
+                "orderID": order_doc.id,
+                "createdAt": created_at,
+                "Price_orderid": order.get("Price_orderid"),
+                "costservice_thisorder": order.get("costservice_thisorder"),
+                "items": order.get("items", {})
+            })
+
+        next_cursor = None
+        if len(order_docs) == page_size:
+            next_cursor = encode_cursor(order_docs[-1])
+
+        return jsonify({
+            "success": True,
+            "stempID": stemp_id,
+            "orders": orders,
+            "nextCursor": next_cursor
+        }), 200
+
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
 #--------------------------------
+def costrider_period(stemp_doc):
+    """STEMP 1 ช่วง + order ในช่วงนั้น (memory ต่อครั้ง = 1 ช่วง)"""
+    stemp = stemp_doc.to_dict() or {}
+
+    stemp_data = {
+        "stempId": stemp_doc.id,
+        "price_allorderID": float(stemp.get("price_allorderID", 0)),
+        "costrider_allorderID": float(stemp.get("costrider_allorderID", 0)),
+        "pay": stemp.get("pay", "not"),
+        "start_createdAt": (
+            stemp.get("start_createdAt").timestamp()
+            if stemp.get("start_createdAt")
+            else None
+        ),
+        "Orders": []
+    }
+
+    # ------------------------------------------------
+    # orders under STEMP
+    # ------------------------------------------------
+    orders_ref = (
+        stemp_doc.reference
+        .collection("orders")
+        .order_by(
+            "createdAt",
+            direction=firestore.Query.DESCENDING
+        )
+    )
+
+    # ====================================================
+    # LOOP ORDER
+    # ====================================================
+    for order_doc in orders_ref.stream():
+        order = order_doc.to_dict() or {}
+
+        # ---------------- items (dict → list) ----------------
+        items_list = []
+        raw_items = order.get("items", {})
+
+        for item in raw_items.values():
+            items_list.append({
+                "productname": item.get("productname", ""),
+                "ProductDetail": item.get("ProductDetail", ""),
+                "priceproduct": float(item.get("priceproduct", 0)),
+                "numberproduct": int(item.get("numberproduct", 1))
+            })
+
+        stemp_data["Orders"].append({
+            "orderId": order.get("orderId"),
+            "Price_orderid": float(order.get("Price_orderid", 0)),
+            "costrider_thisorder": float(order.get("costrider_thisorder", 0)),
+            "createdAt": (
+                order.get("createdAt").timestamp()
+                if order.get("createdAt")
+                else None
+            ),
+            "Items": items_list
+        })
+
+    return stemp_data
+
+
 @app.route("/get_costrider", methods=["GET"])
 def get_costrider():
+    """
+    ส่งทีละ STEMP ระหว่างอ่าน Firestore (stream)
+    default = JSON array เหมือนเดิม, ?format=ndjson = 1 STEMP ต่อบรรทัด
+    """
     try:
         nameOfm = request.args.get("nameOfm")
         del_nameservice = request.args.get("del_nameservice")
+        ndjson = request.args.get("format") == "ndjson"
 
         if not nameOfm or not del_nameservice:
             return jsonify([]), 200
@@ -1251,72 +2434,45 @@ def get_costrider():
               )
         )
 
-        result = []
-
         # ========================================================
         # LOOP STEMP
         # ========================================================
-        for stemp_doc in costservice_col.stream():
-            stemp = stemp_doc.to_dict() or {}
-
-            stemp_data = {
-                "stempId": stemp_doc.id,
-                "price_allorderID": float(stemp.get("price_allorderID", 0)),
-                "costrider_allorderID": float(stemp.get("costrider_allorderID", 0)),
-                "pay": stemp.get("pay", "not"),
-                "start_createdAt": (
-                    stemp.get("start_createdAt").timestamp()
-                    if stemp.get("start_createdAt")
-                    else None
-                ),
-                "Orders": []
-            }
-
-            # ------------------------------------------------
-            # orders under STEMP
-            # ------------------------------------------------
-            orders_ref = (
-                stemp_doc.reference
-                .collection("orders")
-                .order_by(
-                    "createdAt",
-                    direction=firestore.Query.DESCENDING
-                )
-            )
-
-            # ====================================================
-            # LOOP ORDER
-            # ====================================================
-            for order_doc in orders_ref.stream():
-                order = order_doc.to_dict() or {}
-
-                # ---------------- items (dict → list) ----------------
-                items_list = []
-                raw_items = order.get("items", {})
-
-                for item in raw_items.values():
-                    items_list.append({
-                        "productname": item.get("productname", ""),
-                        "ProductDetail": item.get("ProductDetail", ""),
-                        "priceproduct": float(item.get("priceproduct", 0)),
-                        "numberproduct": int(item.get("numberproduct", 1))
-                    })
-
-                stemp_data["Orders"].append({
-                    "orderId": order.get("orderId"),
-                    "Price_orderid": float(order.get("Price_orderid", 0)),
-                    "costrider_thisorder": float(order.get("costrider_thisorder", 0)),
-                    "createdAt": (
-                        order.get("createdAt").timestamp()
-                        if order.get("createdAt")
-                        else None
-                    ),
-                    "Items": items_list
-                })
-
-            result.append(stemp_data)
-
-        return jsonify(result), 200
+        periods = (costrider_period(d) for d in costservice_col.stream())
+
+        # อ่าน STEMP แรกก่อน → error ของ query ยังตอบ 500 ได้
+        first = next(periods, None)
+
+        def generate():
+            try:
+                if ndjson:
+                    if first is not None:
+                        yield app.json.dumps(first) + "\n"
+                    for period in periods:
+                        yield app.json.dumps(period) + "\n"
+                    return
+
+                yield "["
+                if first is not None:
+                    yield app.json.dumps(first)
+                for period in periods:
+                    yield "," + app.json.dumps(period)
+                yield "]"
+
+            except Exception as e:
+                # header 200 ส่งไปแล้ว → client ต้องรู้ว่าข้อมูลไม่ครบ
+                traceback.print_exc()
+                if ndjson:
+                    # บรรทัดสุดท้ายเป็น error record
+                    yield app.json.dumps({"success": False, "error": str(e)}) + "\n"
+                    return
+                # JSON array → raise ให้ตัด connection (array ไม่ปิด = parse ไม่ผ่าน)
+                raise
+
+        return Response(
+            stream_with_context(generate()),
+            status=200,
+            mimetype="application/x-ndjson" if ndjson else "application/json"
+        )
 
     except Exception as e:
         traceback.print_exc()
@@ -1328,6 +2484,80 @@ def get_costrider():
 
 
 #-----------------------------
+def calc_shop_total(items):
+    shop_total = 0.00
+    for item in items.values():
+        price = round(float(item.get("priceproduct", 0)), 2)
+        qty   = int(item.get("numberproduct", 1))
+        shop_total += round(price * qty, 2)
+
+    return round(shop_total, 2)
+
+
+#-----------------------------
+# pointer ไปยัง STEMP ที่ยังไม่จ่าย (pay == not) ของแต่ละบัญชี
+# เก็บที่ field "open_stemp" ของ partner/{shop}, delivery/{rider}
+# และ cache ใน process → ปกติอ่านแค่ STEMP doc 1 ครั้ง (ไม่ query)
+# pay ถูกเปลี่ยนนอก server นี้ → ตรวจ STEMP ที่ cache ไว้ทุก order
+STEMP_POINTER_TTL = float(os.environ.get("STEMP_POINTER_TTL", 300))
+_stemp_pointer_cache = {}   # account path -> (stemp_id, cached_at)
+
+
+@firestore.transactional
+def _resolve_open_stemp(transaction, account_ref, total_field):
+    """
+    อ่าน pointer ใน transaction
+    ถ้า STEMP ถูกจ่ายแล้ว / ยังไม่มี → สร้างใหม่และย้าย pointer (roll)
+    order ที่มาพร้อมกันจะ retry และเห็น STEMP เดียวกัน → ไม่เกิด STEMP ซ้ำ
+    """
+    costservice_col = account_ref.collection("costservice")
+
+    account = account_ref.get(transaction=transaction)
+    stemp_id = (account.to_dict() or {}).get("open_stemp") if account.exists else None
+
+    if stemp_id:
+        stemp = costservice_col.document(stemp_id).get(transaction=transaction)
+        if stemp.exists and (stemp.to_dict() or {}).get("pay") == "not":
+            return stemp_id
+    else:
+        # ข้อมูลเก่าที่ยังไม่มี pointer → หาแบบเดิมครั้งเดียว
+        for d in transaction.get(costservice_col.where("pay", "==", "not").limit(1)):
+            transaction.set(account_ref, {"open_stemp": d.id}, merge=True)
+            return d.id
+
+    stemp_id = f"STEMP_{int(time.time())}"
+    transaction.set(costservice_col.document(stemp_id), {
+        "price_allorderID": 0.00,
+        total_field: 0.00,
+        "pay": "not",
+        "start_createdAt": firestore.SERVER_TIMESTAMP
+    })
+    transaction.set(account_ref, {"open_stemp": stemp_id}, merge=True)
+    return stemp_id
+
+
+def open_stemp_ref(account_ref, total_field):
+    """STEMP ที่ยังไม่จ่ายของ account (partner หรือ delivery)"""
+    costservice_col = account_ref.collection("costservice")
+    cached = _stemp_pointer_cache.get(account_ref.path)
+
+    if cached and time.time() - cached[1] < STEMP_POINTER_TTL:
+        # ยังไม่จ่าย → ใช้ต่อได้, จ่ายแล้ว/ถูกลบ → resolve ใหม่ (roll)
+        stemp = costservice_col.document(cached[0]).get()
+        if stemp.exists and (stemp.to_dict() or {}).get("pay") == "not":
+            return stemp.reference
+        invalidate_stemp_pointer(account_ref)
+
+    stemp_id = _resolve_open_stemp(db.transaction(), account_ref, total_field)
+    _stemp_pointer_cache[account_ref.path] = (stemp_id, time.time())
+
+    return costservice_col.document(stemp_id)
+
+
+def invalidate_stemp_pointer(account_ref):
+    _stemp_pointer_cache.pop(account_ref.path, None)
+
+
 @app.route("/confirm_order", methods=["POST"])
 def confirm_order():
     try:
@@ -1343,9 +2573,10 @@ def confirm_order():
         if not all([nameOfm, userName, orderId]):
             return jsonify({"success": False, "error": "missing parameter"}), 400
 
+        ofm_ref = db.collection("OFM_name").document(nameOfm)
+
         customer_ref = (
-            db.collection("OFM_name")
-              .document(nameOfm)
+            ofm_ref
               .collection("customers")
               .document(userName)
         )
@@ -1356,16 +2587,28 @@ def confirm_order():
               .document(orderId)
         )
 
-        if not order_ref.get().exists:
-            return jsonify({"success": False, "error": "order not found"}), 404
+        # idempotency: 1 document ต่อ orderId + client key
+        # client retry → ได้ response เดิมกลับไป ไม่ Increment ซ้ำ
+        request_key = (
+            request.headers.get("Idempotency-Key")
+            or data.get("requestKey")
+            or "default"
+        )
+        dedupe_ref = order_ref.collection("confirm_requests").document(str(request_key))
 
-        order_ref.update({
-            "status": "orderconfirmed",
-            "Preorder": 0,
-            "confirmedAt": firestore.SERVER_TIMESTAMP
-        })
+        # ==================================================
+        # 1) READ: อ่านทุกอย่างที่ต้องใช้ก่อน (ยังไม่เขียนอะไร)
+        # ==================================================
+        order_snap, dedupe_snap, customer_snap = get_docs([order_ref, dedupe_ref, customer_ref])
+
+        if dedupe_snap.exists:
+            return jsonify((dedupe_snap.to_dict() or {}).get("response", {})), 200
+
+        if not order_snap.exists:
+            return jsonify({"success": False, "error": "order not found"}), 404
 
-        customer_ref.update({"activeOrderId": ""})
+        if (order_snap.to_dict() or {}).get("status") == "orderconfirmed":
+            return jsonify({"success": False, "error": "order already confirmed"}), 409
 
         partner_items = {}
         total_price = 0.00
@@ -1391,41 +2634,106 @@ def confirm_order():
         if not partner_items:
             return jsonify({"success": False, "error": "no items"}), 400
 
+        shop_totals = {
+            partnershop: calc_shop_total(items)
+            for partnershop, items in partner_items.items()
+        }
+
+        delivery_ref = ofm_ref.collection("delivery").document(del_nameservice)
+
+        # ค่าธรรมเนียมใช้ config ชุดเดียวทั้ง order (บันทึก version ไว้ audit)
+        fee_config = get_fee_config()
+
+        # per-shop I/O: หา STEMP ของแต่ละร้าน + rider (อิสระต่อกัน → ทำขนานได้)
+        stemp_tasks = {
+            ("partner", partnershop): partial(
+                open_stemp_ref,
+                ofm_ref.collection("partner").document(partnershop),
+                "costservice_allorderID"
+            )
+            for partnershop in partner_items
+        }
+        stemp_tasks[("delivery", del_nameservice)] = partial(
+            open_stemp_ref, delivery_ref, "costrider_allorderID"
+        )
+
+        stemp_refs, stemp_errors = run_fanout(stemp_tasks)
+
+        if stemp_errors:
+            # ยังไม่ได้เขียนอะไร → client ส่งใหม่ได้
+            return jsonify({
+                "success": False,
+                "error": "costservice lookup failed",
+                "shopErrors": {name: err for (_, name), err in stemp_errors.items()}
+            }), 500
+
+        response = {
+            "success": True,
+            "partnerCount": len(partner_items),
+            "totalprice": round(total_price, 2),
+            "feeconfig_version": fee_config.version
+        }
+
+        # ==================================================
+        # 2) PLAN: สร้าง mutation ทั้งหมด
+        # ==================================================
+        plan = WritePlan()
+
+        # op แรก → อยู่ batch เดียวกับ Increment ทั้งหมด
+        # request ที่มาซ้ำพร้อมกันจะ commit ไม่ผ่าน (AlreadyExists)
+        plan.create(dedupe_ref, {
+            "orderId": orderId,
+            "requestKey": str(request_key),
+            "response": response,
+            "completedAt": firestore.SERVER_TIMESTAMP
+        })
+
+        # order ต้องยังเป็นอย่างที่อ่านไว้ → confirm พร้อมกัน (คนละ key) ผ่านได้แค่ 1
+        plan.update(order_ref, {
+            "status": "orderconfirmed",
+            "Preorder": 0,
+            "confirmedAt": firestore.SERVER_TIMESTAMP
+        }, option=db.write_option(last_update_time=order_snap.update_time))
+
+        plan.update(customer_ref, {
+            "activeOrderId": "",
+            "preorderSyncedId": firestore.DELETE_FIELD,
+            "activePreorder": firestore.DELETE_FIELD
+        })
+
         # notification (ไม่แตะ logic)
         for partnershop, items in partner_items.items():
-            (
-                db.collection("OFM_name")
-                  .document(nameOfm)
+            notify_ref = (
+                ofm_ref
                   .collection("partner")
                   .document(partnershop)
                   .collection("system")
                   .document("notification")
                   .collection("orders")
                   .document(orderId)
-                  .set({
-                      "orderId": orderId,
-                      "nameOfm": nameOfm,
-                      "userName": userName,
-                      "del_nameservice": del_nameservice,
-                      "partnershop": partnershop,
-                      "items": items,
-                      "read": False,
-                      "createdAt": firestore.SERVER_TIMESTAMP
-                  })
             )
+            plan.set(notify_ref, {
+                "orderId": orderId,
+                "nameOfm": nameOfm,
+                "userName": userName,
+                "del_nameservice": del_nameservice,
+                "partnershop": partnershop,
+                "items": items,
+                "read": False,
+                "createdAt": firestore.SERVER_TIMESTAMP
+            })
 
-        call_rider_ref = (
-            db.collection("OFM_name")
-              .document(nameOfm)
-              .collection("delivery")
-              .document(del_nameservice)
-              .collection("orders")
-              .document(orderId)
-        )
+        # snapshot ข้อมูลติดต่อลูกค้า → get_rider_orders ไม่ต้อง join
+        c = (customer_snap.to_dict() or {}) if customer_snap.exists else {}
 
         call_rider_data = {
             "orderId": orderId,
             "username": userName,
+            "customer": {
+                "name": c.get("name", c.get("username", "")),
+                "phone": c.get("phone", ""),
+                "address": c.get("address", "")
+            },
             "pricedelivery": pricedelivery,
             "del_nameservice": del_nameservice,
             "mandelivery": mandelivery,
@@ -1434,20 +2742,14 @@ def confirm_order():
         }
 
         for partnershop, items in partner_items.items():
-            shop_total = 0.00
             shop_block = {"order": "available"}
 
             for itemId, item in items.items():
-                price = round(float(item.get("priceproduct", 0)), 2)
-                qty   = int(item.get("numberproduct", 1))
-
-                shop_total += round(price * qty, 2)
-
                 shop_block[itemId] = {
                     "productname": item.get("productname", ""),
                     "ProductDetail": item.get("ProductDetail", ""),
-                    "priceproduct": price,
-                    "numberproduct": qty,
+                    "priceproduct": round(float(item.get("priceproduct", 0)), 2),
+                    "numberproduct": int(item.get("numberproduct", 1)),
                     "image_url": (
                         item.get("imageurl")
                         or item.get("image_url")
@@ -1455,129 +2757,89 @@ def confirm_order():
                     )
                 }
 
-            shop_total = round(shop_total, 2)
-            shop_block["totalprice"] = shop_total
+            shop_block["totalprice"] = shop_totals[partnershop]
             call_rider_data[partnershop] = shop_block
 
-        call_rider_ref.set(call_rider_data)
+        plan.set(
+            delivery_ref.collection("orders").document(orderId),
+            call_rider_data
+        )
 
         # ---------------- costservice partner ----------------
         for partnershop, items in partner_items.items():
+            shop_total = shop_totals[partnershop]
+            costservice_thisorder = round(calc_costservice(shop_total, fee_config), 2)
 
-            shop_total = 0.00
-            for item in items.values():
-                price = round(float(item.get("priceproduct", 0)), 2)
-                qty   = int(item.get("numberproduct", 1))
-                shop_total += round(price * qty, 2)
-
-            shop_total = round(shop_total, 2)
-            costservice_thisorder = round(calc_costservice(shop_total), 2)
-
-            costservice_col = (
-                db.collection("OFM_name")
-                  .document(nameOfm)
-                  .collection("partner")
-                  .document(partnershop)
-                  .collection("costservice")
-            )
-
-            stemp_doc = None
-            stemp_not_docs = (
-                costservice_col
-                .where("pay", "==", "not")
-                .limit(1)
-                .stream()
-            )
-
-            for d in stemp_not_docs:
-                stemp_doc = d
-                break
-
-            if stemp_doc:
-                stemp_ref = stemp_doc.reference
-            else:
-                stemp_ref = costservice_col.document(f"STEMP_{int(time.time())}")
-                stemp_ref.set({
-                    "price_allorderID": 0.00,
-                    "costservice_allorderID": 0.00,
-                    "pay": "not",
-                    "start_createdAt": firestore.SERVER_TIMESTAMP
-                })
+            stemp_ref = stemp_refs[("partner", partnershop)]
 
-            stemp_ref.collection("orders").document(orderId).set({
+            plan.set(stemp_ref.collection("orders").document(orderId), {
                 "orderId": orderId,
                 "Price_orderid": shop_total,
                 "costservice_thisorder": costservice_thisorder,
+                "feeconfig_version": fee_config.version,
                 "items": items,
                 "createdAt": firestore.SERVER_TIMESTAMP
             })
 
-            stemp_ref.update({
+            plan.update(stemp_ref, {
                 "price_allorderID": firestore.Increment(shop_total),
-                "costservice_allorderID": firestore.Increment(costservice_thisorder)
-            })
-
-        # ---------------- costservice delivery ----------------
-        for partnershop, items in partner_items.items():
-
-            shop_total = 0.00
-            for item in items.values():
-                price = round(float(item.get("priceproduct", 0)), 2)
-                qty   = int(item.get("numberproduct", 1))
-                shop_total += round(price * qty, 2)
-
-            shop_total = round(shop_total, 2)
-            costrider_thisorder = round(calc_costrider(shop_total), 2)
-
-            delivery_costservice_col = (
-                db.collection("OFM_name")
-                  .document(nameOfm)
-                  .collection("delivery")
-                  .document(del_nameservice)
-                  .collection("costservice")
-            )
-
-            stemp_doc = None
-            stemp_not_docs = (
-                delivery_costservice_col
-                .where("pay", "==", "not")
-                .limit(1)
-                .stream()
-            )
+                "costservice_allorderID": firestore.Increment(costservice_thisorder)
+            })
 
-            for d in stemp_not_docs:
-                stemp_doc = d
-                break
+        # ---------------- costservice delivery ----------------
+        # rider คนเดียวทุกร้าน → STEMP เดียว
+        delivery_stemp_ref = stemp_refs[("delivery", del_nameservice)]
 
-            if stemp_doc:
-                stemp_ref = stemp_doc.reference
-            else:
-                stemp_ref = delivery_costservice_col.document(f"STEMP_{int(time.time())}")
-                stemp_ref.set({
-                    "price_allorderID": 0.00,
-                    "costrider_allorderID": 0.00,
-                    "pay": "not",
-                    "start_createdAt": firestore.SERVER_TIMESTAMP
-                })
+        for partnershop, items in partner_items.items():
+            shop_total = shop_totals[partnershop]
+            costrider_thisorder = round(calc_costrider(shop_total, fee_config), 2)
 
-            stemp_ref.collection("orders").document(orderId).set({
+            plan.set(delivery_stemp_ref.collection("orders").document(orderId), {
                 "orderId": orderId,
                 "Price_orderid": shop_total,
                 "costrider_thisorder": costrider_thisorder,
+                "feeconfig_version": fee_config.version,
                 "items": items,
                 "createdAt": firestore.SERVER_TIMESTAMP
             })
 
-            stemp_ref.update({
+            plan.update(delivery_stemp_ref, {
                 "price_allorderID": firestore.Increment(shop_total),
                 "costrider_allorderID": firestore.Increment(costrider_thisorder)
             })
 
-        return jsonify({
-            "success": True,
-            "partnerCount": len(partner_items),
-            "totalprice": round(total_price, 2)
-        }), 200
+        # ==================================================
+        # 3) COMMIT: ปกติ 1 batch (atomic) ต่อ 1 order
+        # ==================================================
+        try:
+            plan.commit()
+        except (gcp_exceptions.Conflict, gcp_exceptions.FailedPrecondition) as e:
+            # request ซ้ำที่ commit ไปก่อนแล้ว → ใช้ผลของมัน
+            stored = dedupe_ref.get()
+            if stored.exists:
+                return jsonify((stored.to_dict() or {}).get("response", {})), 200
+
+            # order ถูกแก้/confirm ไปแล้วหลังอ่าน → ไม่มีอะไรถูกเขียน
+            current = order_ref.get()
+            if current.exists and (current.to_dict() or {}).get("status") == "orderconfirmed":
+                return jsonify({"success": False, "error": "order already confirmed"}), 409
+            if isinstance(e, gcp_exceptions.FailedPrecondition):
+                return jsonify({"success": False, "error": "order changed, please retry"}), 409
+
+            # Aborted (subclass ของ Conflict) ฯลฯ → ไม่ใช่ของซ้ำ ให้ตอบ 500
+            raise
+
+        # แจ้งร้าน (เข้าคิว ไม่รอส่ง)
+        for partnershop in partner_items:
+            send_fcm_to_partner(
+                None,
+                "ออเดอร์ใหม่",
+                f"{userName} สั่งสินค้า",
+                {"orderId": orderId, "nameOfm": nameOfm},
+                token_ref=ofm_ref.collection("partner").document(partnershop)
+            )
+
+        return jsonify(response), 200
 
     except Exception as e:
         traceback.print_exc()
@@ -1693,13 +2955,13 @@ def increase_item_quantity():
           .document(itemId)
     )
 
-    item_doc = item_ref.get()
-    if not item_doc.exists:
+    # Increment ฝั่ง server → 1 round trip, ไม่มี lost update
+    # update = precondition ว่า item ต้องมีอยู่
+    try:
+        item_ref.update({"numberproduct": Increment(1)})
+    except gcp_exceptions.NotFound:
         return jsonify({"status": "not_found"}), 404
 
-    qty = item_doc.to_dict().get("numberproduct", 1)
-    item_ref.update({"numberproduct": qty + 1})
-
     return jsonify({"status": "success"})
 
 #decrease_item_quantity
@@ -1726,14 +2988,10 @@ def decrease_item_quantity():
           .document(itemId)
     )
 
-    item_doc = item_ref.get()
-    if not item_doc.exists:
+    # ต้องไม่ต่ำกว่า 1 → Increment(-1) อย่างเดียวกันไม่ได้ ใช้ transaction
+    if not update_qty(db.transaction(), item_ref, -1):
         return jsonify({"status": "not_found"}), 404
 
-    qty = item_doc.to_dict().get("numberproduct", 1)
-    if qty > 1:
-        item_ref.update({"numberproduct": qty - 1})
-
     return jsonify({"status": "success"})
 
 #delete_item
@@ -1749,27 +3007,322 @@ def delete_item():
     if not all([nameOfm, userName, orderId, itemId]):
         return jsonify({"status": "error"}), 400
 
-    order_ref = (
-        db.collection("OFM_name")
-          .document(nameOfm)
-          .collection("customers")
-          .document(userName)
-          .collection("orders")
-          .document(orderId)
-    )
-
-    item_ref = order_ref.collection("items").document(itemId)
-    item_ref.delete()
+    order_ref = preorder_ref(nameOfm, userName, orderId)
 
-    # update preorder count
-    order_doc = order_ref.get()
-    preorder = order_doc.to_dict().get("Preorder", 1)
-    order_ref.update({"Preorder": max(preorder - 1, 0)})
+    # delete + Preorder Increment(-1) ใน commit เดียว
+    try:
+        apply_cart_ops(order_ref, [{"op": "delete", "itemId": itemId}], nameOfm, userName)
+    except gcp_exceptions.NotFound:
+        return jsonify({"status": "not_found"}), 404
 
     return jsonify({"status": "success"})
 
+#----------------------------------------------
+# cart batch: add / inc / dec / delete หลายรายการใน commit เดียว
+#----------------------------------------------
+def cart_item_data(data, nameOfm, userName, itemId):
+    return {
+        "itemId": itemId,
+        "productname": data.get("productname"),
+        "ProductDetail": data.get("productDetail", ""),
+        "priceproduct": data.get("priceproduct", 0),
+        "image_url": data.get("image_url", ""),
+        "Partnershop": data.get("partnershop", ""),
+        "numberproduct": 1,
+        "status": "draft",
+        "ofmname": nameOfm,
+        "username": userName,
+        "created_at": datetime.utcnow()
+    }
+
+
+def apply_cart_ops(order_ref, ops, nameOfm, userName):
+    """
+    รวม op ต่อ item เป็นผลต่างสุทธิ แล้วเขียนครั้งเดียว
+    - inc อย่างเดียว → WriteBatch + Increment (ไม่ต้องอ่าน)
+    - มีลด / Preorder เปลี่ยน → transaction อ่าน item ที่ลด + customer ด้วย get_all ครั้งเดียว
+      (กันต่ำกว่า 1, mirror Preorder ลง customer เฉพาะ active order ที่ sync แล้ว)
+    - delete มี precondition exists → กดซ้ำ commit ไม่ผ่าน (NotFound) Preorder ไม่ลด
+    - item ไม่มีอยู่ → NotFound ทั้ง batch ไม่ว่า op ไหน (inc / dec / delete)
+    คืน list itemId ที่สร้างใหม่ (ตามลำดับ op add)
+    """
+    items_col = order_ref.collection("items")
+
+    adds = []       # (item_ref, data)
+    deltas = {}     # itemId -> จำนวนที่เปลี่ยน
+    deletes = []
+
+    for op in ops:
+        if not isinstance(op, dict):
+            raise ValueError("op must be an object")
+        kind = op.get("op")
+
+        if kind == "add":
+            if not op.get("productname"):
+                raise ValueError("add: missing productname")
+            item_ref = items_col.document()
+            adds.append((item_ref, cart_item_data(op, nameOfm, userName, item_ref.id)))
+
+        elif kind in ("inc", "dec"):
+            item_id = op.get("itemId")
+            if not item_id:
+                raise ValueError(f"{kind}: missing itemId")
+            try:
+                step = int(op.get("count", 1))
+            except (TypeError, ValueError):
+                raise ValueError(f"{kind}: invalid count")
+            if step < 1:
+                raise ValueError(f"{kind}: count must be >= 1")
+            deltas[item_id] = deltas.get(item_id, 0) + (step if kind == "inc" else -step)
+
+        elif kind == "delete":
+            item_id = op.get("itemId")
+            if not item_id:
+                raise ValueError("delete: missing itemId")
+            if item_id not in deletes:
+                deletes.append(item_id)
+
+        else:
+            raise ValueError(f"unknown op: {kind}")
+
+    for item_id in deletes:
+        deltas.pop(item_id, None)
+
+    customer_ref = order_ref.parent.parent
+    preorder_delta = len(adds) - len(deletes)
+
+    def write(writer, current, mirror=False):
+        for item_ref, data in adds:
+            writer.set(item_ref, data)
+
+        for item_id, delta in deltas.items():
+            item_ref = items_col.document(item_id)
+            if delta > 0:
+                writer.update(item_ref, {"numberproduct": Increment(delta)})
+            elif delta < 0:
+                writer.update(item_ref, {"numberproduct": max(current[item_id] + delta, 1)})
+
+        for item_id in deletes:
+            writer.delete(items_col.document(item_id), option=db.write_option(exists=True))
+
+        if preorder_delta:
+            writer.update(order_ref, {"Preorder": Increment(preorder_delta)})
+            if mirror:
+                writer.update(customer_ref, {"activePreorder": Increment(preorder_delta)})
+
+    # มี dec (รวมที่หักกับ inc แล้วเหลือ 0) → ต้องอ่านค่าปัจจุบัน + ตรวจว่ามี item
+    read_refs = [items_col.document(i) for i, d in deltas.items() if d <= 0]
+
+    try:
+        if read_refs or preorder_delta:
+            @firestore.transactional
+            def run(transaction):
+                current = {}
+                mirror = False
+                for snap in transaction.get_all(read_refs + [customer_ref]):
+                    if snap.reference.path == customer_ref.path:
+                        # order อื่น / mirror ยังไม่ sync → ไม่แตะ (get_preorder backfill เอง)
+                        customer = (snap.to_dict() or {}) if snap.exists else {}
+                        mirror = (
+                            customer.get("activeOrderId") == order_ref.id
+                            and customer.get("preorderSyncedId") == order_ref.id
+                        )
+                    elif not snap.exists:
+                        raise gcp_exceptions.NotFound(f"item not found: {snap.id}")
+                    else:
+                        current[snap.id] = (snap.to_dict() or {}).get("numberproduct", 1)
+                write(transaction, current, mirror)
+
+            run(db.transaction())
+        else:
+            batch = db.batch()
+            write(batch, {})
+            batch.commit()
+    except gcp_exceptions.FailedPrecondition as e:
+        # precondition ไม่ผ่าน = item ถูกลบไปแล้ว → ให้ caller ตอบ 404 เหมือนกัน
+        raise gcp_exceptions.NotFound(str(e)) from e
+
+    return [item_ref.id for item_ref, _ in adds]
+
+
+@app.route("/cart/batch", methods=["POST"])
+def cart_batch():
+    data = request.json or {}
+
+    nameOfm = data.get("nameOfm")
+    userName = data.get("userName")
+    orderId = data.get("orderId")
+    ops = data.get("ops") or []
+
+    if not all([nameOfm, userName, orderId]) or not isinstance(ops, list) or not ops:
+        return jsonify({"status": "error"}), 400
+
+    order_ref = preorder_ref(nameOfm, userName, orderId)
+
+    try:
+        item_ids = apply_cart_ops(order_ref, ops, nameOfm, userName)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except gcp_exceptions.NotFound:
+        return jsonify({"status": "not_found"}), 404
+
+    return jsonify({
+        "status": "success",
+        "orderId": orderId,
+        "itemIds": item_ids
+    })
+
+
+
+# Image processing (save_product)
+# โหลดแบบ stream + จำกัดขนาด → ลบ EXIF → ย่อ → encode JPEG ใหม่
+# ------------------------------
+IMAGE_DOWNLOAD_TIMEOUT = 15                 # วินาที
+IMAGE_MAX_BYTES = 15 * 1024 * 1024          # ไฟล์ต้นฉบับสูงสุด
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", 1280))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", 80))
+# ไฟล์เล็กแต่ decode แล้วใหญ่ได้ (PNG บีบอัดสูง) → จำกัดจำนวน pixel ก่อน decode
+IMAGE_MAX_PIXELS = int(os.environ.get("IMAGE_MAX_PIXELS", 40_000_000))
+
+
+def download_image(url):
+    """คืน bytes (None ถ้า status ไม่ใช่ 200), ไฟล์ใหญ่เกิน → ValueError"""
+    with requests.get(url, stream=True, timeout=IMAGE_DOWNLOAD_TIMEOUT) as response:
+        if response.status_code != 200:
+            return None
+
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > IMAGE_MAX_BYTES:
+            raise ValueError("Image too large")
+
+        buf = BytesIO()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            buf.write(chunk)
+            if buf.tell() > IMAGE_MAX_BYTES:
+                raise ValueError("Image too large")
+
+        return buf.getvalue()
+
+
+def optimize_image(raw, max_dimension=IMAGE_MAX_DIMENSION, quality=IMAGE_JPEG_QUALITY):
+    img = Image.open(BytesIO(raw))     # อ่านแค่ header ยังไม่ decode
+
+    width, height = img.size
+    if width * height > IMAGE_MAX_PIXELS:
+        raise ValueError("Image too large")
+
+    # JPEG → ให้ decoder ย่อ (1/2, 1/4, 1/8) ระหว่าง decode เลย
+    if img.format == "JPEG":
+        img.draft("RGB", (max_dimension, max_dimension))
+
+    # หมุนตาม EXIF ก่อน เพราะ save ใหม่จะไม่มี EXIF แล้ว
+    img = ImageOps.exif_transpose(img)
+
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+    out = BytesIO()
+    img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+# ขนาดรูปที่สร้างตอนอัปโหลด
+# full  → {ofm}/{shop}/{mode}/{product}.jpg (path เดิม)
+# อื่นๆ → _sizes/{size}/{ofm}/{shop}/{mode}/{product}.jpg
+IMAGE_SIZES = {
+    "thumb": 200,
+    "medium": 640,
+    "full": IMAGE_MAX_DIMENSION,
+}
+IMAGE_SIZES_ROOT = "_sizes"
+
+# upload ใช้ pool ของตัวเอง ไม่แย่ง fanout ของ confirm_order
+# timeout ต่อ request ของ GCS → upload ไม่ค้างต่อหลัง save_product ตอบไปแล้ว
+IMAGE_UPLOAD_WORKERS = int(os.environ.get("IMAGE_UPLOAD_WORKERS", 4))
+IMAGE_UPLOAD_TIMEOUT = float(os.environ.get("IMAGE_UPLOAD_TIMEOUT", 60))   # วินาที
+
+_image_upload_executor = ThreadPoolExecutor(
+    max_workers=IMAGE_UPLOAD_WORKERS,
+    thread_name_prefix="image-upload"
+)
+
+
+def image_size_path(storage_path, size):
+    if size == "full":
+        return storage_path
+    return f"{IMAGE_SIZES_ROOT}/{size}/{storage_path}"
+
+
+def public_image_url(storage_path):
+    return f"https://storage.googleapis.com/{bucket.name}/{storage_path}"
+
+
+def image_size_urls(storage_path):
+    return {size: public_image_url(image_size_path(storage_path, size)) for size in IMAGE_SIZES}
+
 
+def product_image_urls(data):
+    """สินค้าเก่าที่ไม่มีรูปย่อ → ทุกขนาดใช้ image_url เดิม"""
+    image_urls = data.get("image_urls")
+    if image_urls:
+        return image_urls
+    image_url = data.get("image_url", "")
+    return {size: image_url for size in IMAGE_SIZES}
+
+
+def render_image_sizes(raw):
+    """สร้างรูปทุกขนาด (ย่อจาก full → decode รอบเล็กกว่า) คืน {size: bytes}"""
+    full = optimize_image(raw)
+    return {
+        size: full if size == "full" else optimize_image(full, dimension)
+        for size, dimension in IMAGE_SIZES.items()
+    }
+
+
+def upload_image_sizes(storage_path, renditions):
+    """อัปโหลดทุกขนาดขนานกัน คืน {size: url} (พัง → ลบรูปย่อที่อัปไปแล้ว)"""
+    def upload(size):
+        blob = bucket.blob(image_size_path(storage_path, size))
+        blob.upload_from_file(
+            BytesIO(renditions[size]),
+            content_type="image/jpeg",
+            timeout=IMAGE_UPLOAD_TIMEOUT
+        )
+        blob.make_public(timeout=IMAGE_UPLOAD_TIMEOUT)
+        return blob
+
+    futures = {_image_upload_executor.submit(upload, size): size for size in renditions}
+    # ทุกงานมี timeout ของตัวเอง → รอครบทุกตัว ไม่มี upload ค้างหลังตอบ
+    wait(futures)
+
+    uploaded, errors = [], {}
+    for f, size in futures.items():
+        try:
+            blob = f.result()
+            # full = path เดิมที่ product doc เก่าอาจใช้อยู่ → ไม่ลบ
+            if size != "full":
+                uploaded.append(blob)
+        except Exception as e:
+            errors[size] = str(e)
+
+    if errors:
+        for blob in uploaded:
+            try:
+                blob.delete()
+            except Exception as e:
+                print("image cleanup error:", e)
+        raise RuntimeError(f"image upload failed: {errors}")
+
+    return image_size_urls(storage_path)
 
+# ------------------------------
 # Save product route
 # ------------------------------
 @app.route("/save_product", methods=["POST"])
@@ -1800,24 +3353,32 @@ def save_product():
 
         # 1) Upload image
         storage_path = f"{name_ofm}/{slave_name}/{view_modename}/{view_productname}.jpg"
-        blob = bucket.blob(storage_path)
 
-        response = requests.get(preview_image_url)
-        if response.status_code != 200:
+        try:
+            raw_image = download_image(preview_image_url)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+
+        if raw_image is None:
             return jsonify({
                 "success": False,
                 "message": "Failed to download image from MAUI"
             }), 400
 
-        blob.upload_from_file(
-            BytesIO(response.content),
-            content_type="image/jpeg"
-        )
+        try:
+            renditions = render_image_sizes(raw_image)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+        except Exception:
+            return jsonify({"success": False, "message": "Invalid image"}), 400
 
-        # ✅ เพิ่มแค่บรรทัดนี้
-        blob.make_public()
+        image_urls = upload_image_sizes(storage_path, renditions)
+        image_url = image_urls["full"]
 
-        image_url = f"https://storage.googleapis.com/{bucket.name}/{storage_path}"
+        add_to_image_manifest(
+            name_ofm, slave_name, view_modename,
+            [f"{view_productname}.jpg"], derived=True
+        )
 
          
 
@@ -1841,6 +3402,7 @@ def save_product():
             "productname":view_productname,
             "priceproduct":priceproduct,
             "image_url": image_url,
+            "image_urls": image_urls,
             "created_at": datetime.utcnow()
         })
 
@@ -1855,13 +3417,20 @@ def save_product():
         if not mode_ref.get().exists:
             mode_ref.set({
                 "view_modename": view_modename,
+                "shops": [slave_name],
                 "created_at": datetime.utcnow()
             })
+        else:
+            # index mode → shops สำหรับ get_shops_by_mode
+            mode_ref.update({"shops": firestore.ArrayUnion([slave_name])})
+
+        invalidate_catalog(name_ofm)
 
         return jsonify({
             "success": True,
             "message": "Product saved successfully!",
-            "image_url": image_url
+            "image_url": image_url,
+            "image_urls": image_urls
         })
 
     except Exception as e:
@@ -1917,6 +3486,106 @@ def load_orders():
             "error": str(e)
         }), 500
 
+# ------------------------------------
+# Session token
+# login ครั้งแรกตรวจรหัสผ่าน → ได้ token (เซ็น + หมดอายุ)
+# ครั้งต่อไปส่ง token มาแทน → ตรวจในเครื่อง ไม่อ่าน DB ไม่ hash
+# ------------------------------------
+SESSION_SECRET = (
+    os.environ.get("SESSION_SECRET")
+    or hashlib.sha256(service_account_json.encode("utf-8")).hexdigest()
+)
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 7 * 24 * 3600))   # วินาที
+
+_session_serializer = URLSafeTimedSerializer(SESSION_SECRET, salt="ofm-session")
+
+
+def issue_session_token(role, name_ofm, name, extra=None):
+    return _session_serializer.dumps({
+        "r": role,
+        "o": name_ofm,
+        "n": name,
+        "x": extra or {}
+    })
+
+
+def verify_session_token(token, role=None):
+    try:
+        session = _session_serializer.loads(token, max_age=SESSION_TTL)
+    except BadSignature:   # รวม SignatureExpired
+        return None
+
+    if role and session.get("r") != role:
+        return None
+    return session
+
+
+def session_from_request(data, role, name_ofm="", name=""):
+    """token จาก body "token" หรือ Authorization: Bearer ต้องตรงกับ ofm/ชื่อที่ส่งมา"""
+    token = data.get("token")
+    auth = request.headers.get("Authorization", "")
+    if not token and auth.startswith("Bearer "):
+        token = auth[len("Bearer "):]
+
+    if not token:
+        return None
+
+    session = verify_session_token(token, role)
+    if not session:
+        return None
+    if name_ofm and session["o"] != name_ofm:
+        return None
+    if name and session["n"] != name:
+        return None
+
+    session["token"] = token
+    return session
+
+
+# PBKDF2 ช้าโดยตั้งใจ → ทำใน process pool ไม่กิน CPU ของ request thread
+PASSWORD_POOL_WORKERS = int(os.environ.get("PASSWORD_POOL_WORKERS", 2))
+PASSWORD_CHECK_TIMEOUT = 10
+_password_pool = None
+_password_pool_lock = threading.Lock()
+
+
+def verify_password(password_hash, password):
+    global _password_pool
+
+    with _password_pool_lock:
+        if _password_pool is None:
+            # spawn: ไม่ fork process ที่มี grpc/thread อยู่แล้ว
+            _password_pool = ProcessPoolExecutor(
+                max_workers=PASSWORD_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        pool = _password_pool
+
+    try:
+        return pool.submit(check_password_hash, password_hash, password).result(
+            timeout=PASSWORD_CHECK_TIMEOUT
+        )
+    except BrokenProcessPool:
+        with _password_pool_lock:
+            _password_pool = None
+        return check_password_hash(password_hash, password)
+
+
+@app.route("/verify_session", methods=["POST"])
+def verify_session():
+    data = request.get_json(silent=True) or {}
+    session = session_from_request(data, None)
+
+    if not session:
+        return jsonify({"status": "invalid_token"}), 401
+
+    return jsonify({
+        "status": "success",
+        "role": session["r"],
+        "nameofm": session["o"],
+        "name": session["n"]
+    })
+
 # ------------------------------------
 # Admin Login
 # ------------------------------------
@@ -1927,6 +3596,10 @@ def ofm_password():
         nameofm = data.get("nameofm")
         adminpassword = data.get("adminpassword")
 
+        session = session_from_request(data, "admin", nameofm)
+        if session:
+            return jsonify(dict(session["x"], status="success", token=session["token"]))
+
         if not nameofm or not adminpassword:
             return jsonify({"status": "error", "message": "ข้อมูลไม่ครบ"}), 400
 
@@ -1942,14 +3615,19 @@ def ofm_password():
             return jsonify({"status": "not_found"}), 200
 
         doc_data = admin_doc.to_dict()
-        if not check_password_hash(doc_data.get("addminpass"), adminpassword):
+        if not verify_password(doc_data.get("addminpass"), adminpassword):
             return jsonify({"status": "wrong_password"}), 200
 
-        return jsonify({
-            "status": "success",
+        admin_info = {
             "adminname": doc_data.get("admin_name", ""),
             "adminadd": doc_data.get("adminadd", "")
-        })
+        }
+
+        return jsonify(dict(
+            admin_info,
+            status="success",
+            token=issue_session_token("admin", nameofm, nameofm, admin_info)
+        ))
 
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -2023,9 +3701,213 @@ def search_adminmaster():
     return jsonify([{"OFM_name": d.to_dict().get("OFM_name")} for d in docs])
 
 # ------------------------------------
- 
+# Catalog snapshot ต่อ OFM (ใช้กับ get_market_page)
+# on_snapshot listener คอย update สินค้าใน memory
+# ถ้า listener ใช้ไม่ได้ → โหลดใหม่ตาม TTL / เมื่อ save_product
+# ------------------------------------
 import traceback
 
+CATALOG_MAX_OFMS = int(os.environ.get("CATALOG_MAX_OFMS", 20))
+CATALOG_IDLE_SECONDS = float(os.environ.get("CATALOG_IDLE_SECONDS", 600))
+CATALOG_TTL = float(os.environ.get("CATALOG_TTL", 300))       # เฉพาะตอนไม่มี listener
+CATALOG_READY_TIMEOUT = 10
+
+
+def catalog_product(d):
+    # เก็บเฉพาะ field ที่ใช้ → memory ต่อสินค้าคงที่
+    return {
+        "mode": d.get("mode"),
+        "partnershop": d.get("partnershop"),
+        "productname": d.get("productname"),
+        "dataproduct": d.get("dataproduct"),
+        "priceproduct": d.get("priceproduct"),
+        "image_url": d.get("image_url"),
+        "image_urls": product_image_urls(d)
+    }
+
+
+def build_market_page(products):
+    index = {}
+    modes = set()
+
+    for d in products:
+        mode = d.get("mode")
+        shop = d.get("partnershop")
+
+        if not mode or not shop:
+            continue
+
+        modes.add(mode)
+
+        index.setdefault(mode, {}).setdefault(shop, []).append({
+            "productname": d.get("productname"),
+            "dataproduct": d.get("dataproduct"),
+            "priceproduct": d.get("priceproduct"),
+            "image_url": d.get("image_url"),
+            "image_urls": d.get("image_urls")
+        })
+
+    result = {
+        "success": True,
+        "modes": list(modes),
+        "shops": {}
+    }
+
+    for mode in result["modes"]:
+        result["shops"][mode] = index.get(mode, {})
+
+    return result
+
+
+class CatalogSnapshot:
+    def __init__(self, name_ofm):
+        self.name_ofm = name_ofm
+        self.products = {}          # doc path -> catalog_product
+        self.page = None            # response ที่ build แล้ว
+        self.watch = None
+        self.watch_failed = False   # ตั้งโดย _on_snapshot เมื่อ apply snapshot ไม่ผ่าน
+        self.loaded_at = 0.0
+        self.last_access = time.time()
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+
+    def query(self):
+        return db.collection_group("product").where("name_ofm", "==", self.name_ofm)
+
+    def start(self):
+        try:
+            self.watch = self.query().on_snapshot(self._on_snapshot)
+        except Exception as e:
+            print("catalog listener error:", e)
+            self.watch = None
+
+        if not self.watch or not self.ready.wait(CATALOG_READY_TIMEOUT):
+            self.close()
+            self.load()
+
+    def _on_snapshot(self, docs, changes, read_time):
+        try:
+            with self.lock:
+                for change in changes:
+                    path = change.document.reference.path
+                    if change.type.name == "REMOVED":
+                        self.products.pop(path, None)
+                    else:
+                        self.products[path] = catalog_product(change.document.to_dict() or {})
+
+                self.page = None
+                self.loaded_at = time.time()
+        except Exception as e:
+            # products อาจไม่ครบแล้ว → get_page จะปิด listener แล้วโหลดใหม่
+            print("catalog snapshot error:", e)
+            self.watch_failed = True
+
+        self.ready.set()
+
+    def watch_alive(self):
+        # listener ตายเงียบ ๆ ได้ (error / stream ปิด) → self.watch ยังไม่เป็น None
+        watch = self.watch
+        if not watch or self.watch_failed:
+            return False
+        return watch.is_active
+
+    def load(self):
+        products = {
+            p.reference.path: catalog_product(p.to_dict() or {})
+            for p in self.query().stream()
+        }
+        with self.lock:
+            self.products = products
+            self.page = None
+            self.loaded_at = time.time()
+        self.ready.set()
+
+    def get_page(self):
+        self.last_access = time.time()
+
+        if self.watch and not self.watch_alive():
+            # ข้อมูลหลัง listener ตายไม่ครบ → ปิดแล้วโหลดใหม่ทันที จากนั้นใช้ TTL
+            print("catalog listener closed:", self.name_ofm)
+            self.close()
+            self.loaded_at = 0.0
+
+        if not self.watch and time.time() - self.loaded_at > CATALOG_TTL:
+            self.load()
+
+        with self.lock:
+            if self.page is None:
+                self.page = build_market_page(self.products.values())
+            return self.page
+
+    def close(self):
+        if self.watch:
+            try:
+                self.watch.unsubscribe()
+            except Exception as e:
+                print("catalog unsubscribe error:", e)
+        self.watch = None
+
+
+_catalogs = OrderedDict()       # name_ofm -> CatalogSnapshot (LRU)
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(name_ofm):
+    now = time.time()
+    evicted = []
+
+    with _catalogs_lock:
+        catalog = _catalogs.get(name_ofm)
+        if catalog:
+            _catalogs.move_to_end(name_ofm)
+
+        # OFM ที่ไม่มีคนเปิดนาน → ปิด listener คืน memory
+        for key, c in list(_catalogs.items()):
+            if key != name_ofm and now - c.last_access > CATALOG_IDLE_SECONDS:
+                evicted.append(_catalogs.pop(key))
+
+        if not catalog:
+            catalog = CatalogSnapshot(name_ofm)
+            _catalogs[name_ofm] = catalog
+
+            while len(_catalogs) > CATALOG_MAX_OFMS:
+                evicted.append(_catalogs.popitem(last=False)[1])
+
+            is_new = True
+        else:
+            is_new = False
+
+    for c in evicted:
+        c.close()
+
+    if is_new:
+        try:
+            catalog.start()
+        except Exception:
+            with _catalogs_lock:
+                if _catalogs.get(name_ofm) is catalog:
+                    _catalogs.pop(name_ofm)
+            raise
+    else:
+        catalog.ready.wait(CATALOG_READY_TIMEOUT)
+
+    return catalog
+
+
+def invalidate_catalog(name_ofm):
+    """save_product เรียก → ถ้าไม่มี listener (หรือ listener ตาย) ให้โหลดใหม่รอบหน้า"""
+    with _catalogs_lock:
+        catalog = _catalogs.get(name_ofm)
+        if catalog and not catalog.watch_alive():
+            _catalogs.pop(name_ofm, None)
+        else:
+            catalog = None
+
+    # รอบหน้า get_catalog สร้างใหม่ → เปิด listener ใหม่ด้วย
+    if catalog:
+        catalog.close()
+
+
 @app.route("/get_market_page", methods=["GET"])
 def get_market_page():
     try:
@@ -2037,54 +3919,107 @@ def get_market_page():
                 "error": "name_ofm required"
             }), 400
 
-        products = (
-            db.collection_group("product")
-              .where("name_ofm", "==", name_ofm)
-              .stream()
-        )
+        return jsonify(get_catalog(name_ofm).get_page())
 
-        index = {}
-        modes = set()
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
 
-        for p in products:
-            d = p.to_dict()
+# ------------------------------------
+ 
 
-            mode = d.get("mode")
-            shop = d.get("partnershop")
+ 
 
-            if not mode or not shop:
-                continue
+# ------------------------------------
+# image manifest ต่อ folder {ofm}/{shop}/{mode}/
+# OFM_name/{ofm}/image_manifest/{shop}__{mode}
+#   files   = ไฟล์ .jpg ใน folder (save_product เพิ่มชื่อไฟล์)
+#   derived = ไฟล์ที่มีรูปย่อใน _sizes/ แล้ว
+#   complete = list bucket แล้ว (ตั้งโดย backfill เท่านั้น) → files ครบรวมไฟล์เก่า
+# ------------------------------------
+IMAGE_MANIFEST_TTL = float(os.environ.get("IMAGE_MANIFEST_TTL", 30))
+_image_manifests = {}   # prefix -> (files, derived, loaded_at)
 
-            modes.add(mode)
 
-            index.setdefault(mode, {}).setdefault(shop, []).append({
-                "productname": d.get("productname"),
-                "dataproduct": d.get("dataproduct"),
-                "priceproduct": d.get("priceproduct"),
-                "image_url": d.get("image_url")
-            })
+def image_manifest_ref(ofm, shop, mode):
+    return (
+        db.collection("OFM_name")
+          .document(ofm)
+          .collection("image_manifest")
+          .document(f"{shop}__{mode}")
+    )
 
-        result = {
-            "success": True,
-            "modes": list(modes),
-            "shops": {}
-        }
 
-        for mode in result["modes"]:
-            result["shops"][mode] = index.get(mode, {})
+def get_image_manifest(ofm, shop, mode, backfill=True):
+    """
+    คืน (files, derived) — files เรียงตามชื่อเหมือน list_blobs
+    backfill=False → manifest ยังไม่ complete ก็ไม่ list bucket (files อาจไม่ครบ)
+    """
+    prefix = f"{ofm}/{shop}/{mode}/"
 
-        return jsonify(result)
+    cached = _image_manifests.get(prefix)
+    if cached and time.time() - cached[2] < IMAGE_MANIFEST_TTL:
+        return cached[0], cached[1]
+
+    manifest_ref = image_manifest_ref(ofm, shop, mode)
+    doc = manifest_ref.get()
+
+    data = (doc.to_dict() or {}) if doc.exists else {}
+    files = set(data.get("files", []))
+    derived = set(data.get("derived", []))
+
+    if not data.get("complete"):
+        if not backfill:
+            # ไม่ cache → รอบ backfill ถัดไปยัง list bucket
+            return sorted(files), derived
+
+        # save_product อาจสร้าง doc ไว้แค่ไฟล์ใหม่ → list bucket ครั้งเดียวแล้วเก็บไว้
+        listed = [
+            blob.name[len(prefix):]
+            for blob in bucket.list_blobs(prefix=prefix)
+            if blob.name.lower().endswith(".jpg")
+        ]
+        files.update(listed)
+        manifest_ref.set({
+            "files": firestore.ArrayUnion(listed),
+            "complete": True,
+            "updated_at": firestore.SERVER_TIMESTAMP
+        }, merge=True)
 
-    except Exception as e:
-        return jsonify({
-            "success": False,
-            "error": str(e)
-        }), 500
+    files = sorted(files)
 
-# ------------------------------------
- 
+    _image_manifests[prefix] = (files, derived, time.time())
+    return files, derived
+
+
+def add_to_image_manifest(ofm, shop, mode, filenames, derived=False):
+    update = {
+        "files": firestore.ArrayUnion(list(filenames)),
+        "updated_at": firestore.SERVER_TIMESTAMP
+    }
+    if derived:
+        update["derived"] = firestore.ArrayUnion(list(filenames))
+
+    image_manifest_ref(ofm, shop, mode).set(update, merge=True)
+    _image_manifests.pop(f"{ofm}/{shop}/{mode}/", None)
+
+
+def folder_image_urls(prefix, names, derived):
+    """url รูปเต็ม + รูปย่อ (ไฟล์เก่าที่ไม่มีรูปย่อ → ใช้รูปเต็ม)"""
+    images = []
+    thumbs = []
+
+    for name in names:
+        storage_path = f"{prefix}{name}"
+        images.append(public_image_url(storage_path))
+        thumbs.append(public_image_url(
+            image_size_path(storage_path, "thumb") if name in derived else storage_path
+        ))
+
+    return images, thumbs
 
- 
 
 @app.route("/get_images", methods=["GET"])
 def get_images():
@@ -2094,29 +4029,56 @@ def get_images():
 
     page = int(request.args.get("page", 1))
     page_size = int(request.args.get("page_size", 20))
+    page_token = request.args.get("page_token")
 
     if not ofm or not shop or not mode:
         return jsonify({"error": "missing params"}), 400
 
     prefix = f"{ofm}/{shop}/{mode}/"
-    images = []
 
-    for blob in bucket.list_blobs(prefix=prefix):
-        if blob.name.lower().endswith(".jpg"):
-            images.append(
-                f"https://storage.googleapis.com/{bucket.name}/{blob.name}"
-            )
+    # page_token → ใช้ pagination ของ GCS โดยตรง (อ่านแค่ 1 หน้า)
+    if page_token is not None:
+        blobs = bucket.list_blobs(
+            prefix=prefix,
+            max_results=page_size,
+            page_token=page_token or None
+        )
+        gcs_page = next(blobs.pages, [])
+
+        _, derived = get_image_manifest(ofm, shop, mode, backfill=False)
+        images, thumbs = folder_image_urls(
+            prefix,
+            [
+                blob.name[len(prefix):]
+                for blob in gcs_page
+                if blob.name.lower().endswith(".jpg")
+            ],
+            derived
+        )
+
+        return jsonify({
+            "page_size": page_size,
+            "has_more": bool(blobs.next_page_token),
+            "next_page_token": blobs.next_page_token,
+            "images": images,
+            "thumbs": thumbs
+        })
 
-    total = len(images)
+    files, derived = get_image_manifest(ofm, shop, mode)
+
+    total = len(files)
     start = (page - 1) * page_size
     end = start + page_size
 
+    images, thumbs = folder_image_urls(prefix, files[start:end], derived)
+
     return jsonify({
         "page": page,
         "page_size": page_size,
         "total": total,
         "has_more": end < total,
-        "images": images[start:end]
+        "images": images,
+        "thumbs": thumbs
     })
 #---------------------------register_del ข้อมูลพนักงานส่ง-------
 @app.route("/register_del", methods=["POST"])
@@ -2169,6 +4131,7 @@ def register_del():
             "status": "active",
             "created_at": datetime.utcnow()
         })
+        doc_cache.invalidate(del_ref)
 
         return jsonify({
             "success": True,
@@ -2231,6 +4194,7 @@ def register_customer():
             "password_hash": generate_password_hash(password),
             "created_at": datetime.utcnow()
         })
+        doc_cache.invalidate(user_ref)
 
         return jsonify({
             "success": True,
@@ -2289,6 +4253,7 @@ def register_slave():
             "password_hash": generate_password_hash(password),
             "created_at": datetime.utcnow()
         })
+        doc_cache.invalidate(slave_ref)
 
         # ---------------- Create Storage Folder ----------------
         bucket = storage.bucket()
@@ -2329,6 +4294,16 @@ def del_password():
         del_name = data.get("del_name", "").strip()
         del_password = data.get("del_password", "").strip()
 
+        # -------- session token (ไม่ต้องตรวจรหัสซ้ำ) --------
+        session = session_from_request(data, "del", name_ofm, del_name)
+        if session:
+            return jsonify({
+                "status": "success",
+                "name_ofm": session["o"],
+                "del_name": session["n"],
+                "token": session["token"]
+            }), 200
+
         # -------- validate --------
         if not name_ofm or not del_name or not del_password:
             return jsonify({
@@ -2345,15 +4320,14 @@ def del_password():
               .document(del_name)
         )
 
-        doc = del_ref.get()
+        del_data = doc_cache.get(del_ref, cache_missing=False)
 
         # -------- not found --------
-        if not doc.exists:
+        if del_data is None:
             return jsonify({
                 "status": "not_found"
             }), 200
 
-        del_data = doc.to_dict()
         password_hash = del_data.get("password_hash")
 
         # -------- no password --------
@@ -2363,7 +4337,7 @@ def del_password():
             }), 200
 
         # -------- check password --------
-        if not check_password_hash(password_hash, del_password):
+        if not verify_password(password_hash, del_password):
             return jsonify({
                 "status": "wrong_password"
             }), 200
@@ -2372,7 +4346,8 @@ def del_password():
         return jsonify({
             "status": "success",
             "name_ofm": name_ofm,
-            "del_name": del_name
+            "del_name": del_name,
+            "token": issue_session_token("del", name_ofm, del_name)
         }), 200
 
     except Exception as e:
@@ -2392,6 +4367,16 @@ def user_password():
         user_name = data.get("user_name", "").strip()
         user_password = data.get("user_password", "").strip()
 
+        # -------- session token (ไม่ต้องตรวจรหัสซ้ำ) --------
+        session = session_from_request(data, "user", name_ofm, user_name)
+        if session:
+            return jsonify({
+                "status": "success",
+                "nameofm": session["o"],
+                "username": session["n"],
+                "token": session["token"]
+            }), 200
+
         # -------- validate --------
         if not name_ofm or not user_name or not user_password:
             return jsonify({
@@ -2408,15 +4393,14 @@ def user_password():
               .document(user_name)
         )
 
-        doc = user_ref.get()
+        user_data = doc_cache.get(user_ref, cache_missing=False)
 
         # -------- not found --------
-        if not doc.exists:
+        if user_data is None:
             return jsonify({
                 "status": "not_found"
             }), 200
 
-        user_data = doc.to_dict()
         password_hash = user_data.get("password_hash")
 
         # -------- no password in db --------
@@ -2426,7 +4410,7 @@ def user_password():
             }), 200
 
         # -------- check password --------
-        if not check_password_hash(password_hash, user_password):
+        if not verify_password(password_hash, user_password):
             return jsonify({
                 "status": "wrong_password"
             }), 200
@@ -2435,7 +4419,8 @@ def user_password():
         return jsonify({
             "status": "success",
             "nameofm": name_ofm,
-            "username": user_name
+            "username": user_name,
+            "token": issue_session_token("user", name_ofm, user_name)
         }), 200
 
     except Exception as e:
@@ -2455,6 +4440,16 @@ def slave_password():
         slave_name = data.get("slave_name", "").strip()
         slave_password = data.get("slave_password", "").strip()
 
+        # 🎟️ session token (ไม่ต้องตรวจรหัสซ้ำ)
+        session = session_from_request(data, "slave", name_ofm, slave_name)
+        if session:
+            return jsonify({
+                "status": "success",
+                "nameofm": session["o"],
+                "slavename": session["n"],
+                "token": session["token"]
+            }), 200
+
         # 🔒 validate input
         if not name_ofm or not slave_name or not slave_password:
             return jsonify({
@@ -2471,15 +4466,14 @@ def slave_password():
               .document(slave_name)
         )
 
-        doc = slave_ref.get()
+        slave_data = doc_cache.get(slave_ref, cache_missing=False)
 
         # ❌ ไม่พบร้าน
-        if not doc.exists:
+        if slave_data is None:
             return jsonify({
                 "status": "not_found"
             }), 200
 
-        slave_data = doc.to_dict()
         saved_hash = slave_data.get("password_hash")
 
         # ❌ ไม่มีรหัสในระบบ (กันข้อมูลพัง)
@@ -2489,7 +4483,7 @@ def slave_password():
             }), 200
 
         # ❌ รหัสผ่านไม่ถูก
-        if not check_password_hash(saved_hash, slave_password):
+        if not verify_password(saved_hash, slave_password):
             return jsonify({
                 "status": "wrong_password"
             }), 200
@@ -2498,7 +4492,8 @@ def slave_password():
         return jsonify({
             "status": "success",
             "nameofm": name_ofm,
-            "slavename": slave_name
+            "slavename": slave_name,
+            "token": issue_session_token("slave", name_ofm, slave_name)
         }), 200
 
     except Exception as e:
@@ -2508,6 +4503,54 @@ def slave_password():
             "message": str(e)
         }), 500
 
+#------------------------------------
+# แอปร้านส่ง FCM token มาเก็บที่ partner/{shop}.fcm_token
+# (confirm_order แจ้งร้านผ่าน token นี้)
+@app.route("/register_fcm_token", methods=["POST"])
+def register_fcm_token():
+    try:
+        data = request.get_json(silent=True) or {}
+
+        name_ofm = data.get("name_ofm", "").strip()
+        slave_name = data.get("slave_name", "").strip()
+        fcm_token = data.get("fcm_token", "").strip()
+
+        if not name_ofm or not slave_name or not fcm_token:
+            return jsonify({
+                "status": "error",
+                "message": "missing_parameters"
+            }), 400
+
+        # ต้อง login ร้านแล้ว (token จาก /slave_password)
+        if not session_from_request(data, "slave", name_ofm, slave_name):
+            return jsonify({"status": "invalid_token"}), 401
+
+        slave_ref = (
+            db.collection("OFM_name")
+              .document(name_ofm)
+              .collection("partner")
+              .document(slave_name)
+        )
+
+        try:
+            slave_ref.update({
+                "fcm_token": fcm_token,
+                "fcm_token_updated_at": datetime.utcnow()
+            })
+        except gcp_exceptions.NotFound:
+            return jsonify({"status": "not_found"}), 404
+
+        doc_cache.invalidate(slave_ref)
+
+        return jsonify({"status": "success"}), 200
+
+    except Exception as e:
+        print("REGISTER FCM TOKEN ERROR:", str(e))
+        return jsonify({
+            "status": "server_error",
+            "message": str(e)
+        }), 500
+
 #-----------------------------------
 from datetime import datetime
 
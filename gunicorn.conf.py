@@ -0,0 +1,17 @@
+# gunicorn อ่านไฟล์นี้เองเมื่อรันจาก root ของ repo: gunicorn app:app
+# /partner_notifications/stream ถือ 1 thread ต่อ client จนครบ SSE_MAX_STREAM_SECONDS
+# → ใช้ gthread (sync worker = 1 request ต่อ worker, stream เดียวก็บล็อกทั้ง worker)
+import os
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "8000")
+
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+# app.py จำกัด SSE stream ต่อ worker ที่ SSE_MAX_STREAMS (default = threads // 2)
+# เกิน → 503 + retry → thread ที่เหลือไว้ตอบ API ปกติ
+
+# gthread: timeout = worker ค้างทั้ง process ไม่ใช่ request ยาว → stream ไม่โดนตัด
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5